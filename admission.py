@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+import calendrier
+
+# Admission control. The work an upload causes grows with rows x contracts x
+# days (the cells of the allocation arrays and of the generated sheets), so
+# that product is estimated from the parsed table before anything is
+# generated, and compared with two limits:
+#   - above LIMITE_CELLULES the upload is refused;
+#   - above SEUIL_FLUX it is processed in streaming mode: no in-memory sheet
+#     cache, ledger allocated and written in blocks (see
+#     planning.blocs_grand_livre);
+#   - otherwise it is processed normally.
+# Previews and validation reports longer than LIGNES_APERCU rows are shown
+# one page at a time.
+
+# Cells above which an upload is refused (0 = no limit)
+LIMITE_CELLULES = int(os.environ.get("TIMESHEETS_MAX_CELLS", 10_000_000))
+# Cells above which an upload is processed in streaming mode (0 = always)
+SEUIL_FLUX = int(os.environ.get("TIMESHEETS_STREAM_CELLS", 500_000))
+# Rows shown per page of a preview
+LIGNES_APERCU = int(os.environ.get("TIMESHEETS_PREVIEW_ROWS", 1000))
+# Peak Python memory per cell of a batch in normal mode (parsed table,
+# session sheet cache and ledger), measured with tracemalloc on synthetic
+# uploads; streaming mode needs about half of it
+OCTETS_PAR_CELLULE = 400
+
+DECISIONS = ("normal", "flux", "refus")
+
+def estimer_cout(table):
+    # Cost of the valid rows of a parsed table (see planning.normaliser_upload):
+    # rows, workbooks, cells (contracts x days of the month, summed over
+    # rows) and the memory they are expected to need, in bytes
+    valides = table[table["valide"]]
+    annees = valides["annee"].to_numpy(dtype=int)
+    mois = valides["mois"].to_numpy(dtype=int)
+    jours = np.zeros(len(valides), dtype=np.int64)
+    for annee in np.unique(annees):
+        debuts = np.array(calendrier.index_annee(int(annee))["debuts"])
+        masque = annees == annee
+        jours[masque] = (debuts[1:] - debuts[:-1])[mois[masque] - 1]
+    contrats = valides["contrats"].map(len).to_numpy(dtype=np.int64)
+    cellules = int((contrats * jours).sum())
+    return {
+        "lignes": len(valides),
+        "classeurs": int(valides.groupby(["employe", "annee"]).ngroups) if len(valides) else 0,
+        "cellules": cellules,
+        "octets": cellules * OCTETS_PAR_CELLULE,
+    }
+
+def decider(cout, limite=None, seuil=None):
+    # "refus", "flux" or "normal" for an estimate of estimer_cout; limite
+    # and seuil default to LIMITE_CELLULES and SEUIL_FLUX
+    limite = LIMITE_CELLULES if limite is None else limite
+    seuil = SEUIL_FLUX if seuil is None else seuil
+    if limite and cout["cellules"] > limite:
+        return "refus"
+    if cout["cellules"] > seuil:
+        return "flux"
+    return "normal"
+
+def nb_pages(nb_lignes, taille_page=None):
+    return max(1, -(-nb_lignes // (taille_page or LIGNES_APERCU)))
+
+def page(df, numero, taille_page=None):
+    # Rows of page numero (from 1) of a DataFrame
+    taille_page = taille_page or LIGNES_APERCU
+    return df.iloc[(numero - 1) * taille_page:numero * taille_page]
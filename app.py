@@ -1,211 +1,14 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
-import calendar
-from datetime import date, timedelta, datetime
 from io import BytesIO
-import zipfile
-import openpyxl
-from copy import copy
+import functools
+import hashlib
+import itertools
+import os
 
-# =============================
-# Fonctions auxiliaires
-# =============================
-
-def get_all_days(mois, annee):
-    jours = []
-    current_date = date(annee, mois, 1)
-    while current_date.month == mois:
-        jours.append(current_date)
-        current_date += timedelta(days=1)
-    return jours
-
-def get_jours_ouvres(mois, annee, jours_feries):
-    all_days = get_all_days(mois, annee)
-    jours_ouvres = [d for d in all_days if d.weekday() < 5 and d not in jours_feries]
-    return jours_ouvres
-
-def generer_excel(mois_selectionne, annee_selectionnee, contrats, heures_par_jour, jours_feries, donors=None, is_fr=False, is_en=False, is_es=False):
-    import openpyxl
-    from copy import copy
-    
-    jours_mois = get_all_days(mois_selectionne, annee_selectionnee)
-    jours_ouvres = get_jours_ouvres(mois_selectionne, annee_selectionnee, jours_feries)
-    nb_jours_ouvres = len(jours_ouvres)
-    HEURES_TOTALES = nb_jours_ouvres * heures_par_jour
-
-    heures_cibles = {code: round(HEURES_TOTALES * pct / 100, 2) for code, pct in contrats.items()}
-    contrats_list = list(contrats.keys())
-
-    # Format dates as strings (YYYY-MM-DD)
-    jours_mois_str = [d.strftime("%Y-%m-%d") for d in jours_mois]
-
-    df_repartition = pd.DataFrame(index=contrats_list, columns=jours_mois_str, dtype=float)
-    df_repartition[:] = 0.0
-    heures_restantes = heures_cibles.copy()
-
-    for jour, jour_str in zip(jours_mois, jours_mois_str):
-        if jour.weekday() >= 5 or jour in jours_feries:
-            df_repartition[jour_str] = np.nan
-            continue
-        max_alloc = [min(heures_restantes[code], heures_par_jour) for code in contrats_list]
-        rng = np.random.default_rng()
-        tries = 0
-        while True:
-            props = rng.dirichlet(np.ones(len(contrats_list)))
-            alloc = np.minimum(np.round(props * heures_par_jour * 2) / 2, max_alloc)
-            diff = heures_par_jour - alloc.sum()
-            tries += 1
-            if abs(diff) < 0.01:
-                break
-            idx = np.argmax(max_alloc)
-            if alloc[idx] + diff <= max_alloc[idx] and alloc[idx] + diff >= 0:
-                alloc[idx] += diff
-                break
-            # Add this line to see how many tries per day
-            if tries > 1000:
-                st.write(f"Warning: allocation for {jour_str} took {tries} tries")
-                break
-        for idx, code in enumerate(contrats_list):
-            df_repartition.loc[code, jour_str] = alloc[idx]
-            heures_restantes[code] -= alloc[idx]
-
-    # Add Donor, Financing and Project columns to the left
-    donor_values = [donors.get(code, "") if donors else "" for code in df_repartition.index]
-    financing_values = list(df_repartition.index)
-    project_values = ["" for code in df_repartition.index]  # Add your project data here
-    df_repartition.insert(0, "", project_values)
-    df_repartition.insert(0, "Financing Code", financing_values)
-    df_repartition.insert(0, "Donor", donor_values)
-
-    # Load the existing template and fill it with data
-    try:
-        # Load the template workbook
-        template_wb = openpyxl.load_workbook("Trame timesheet.xlsx")
-        
-        # Create output in memory
-        output = BytesIO()
-        
-        # Save the modified workbook to output
-        template_wb.save(output)
-        
-        # Now reopen and fill with our data
-        output.seek(0)
-        wb = openpyxl.load_workbook(output)
-        ws = wb.active
-        
-        # Fill the data starting from row 8 (as per your previous requirement)
-        start_row = 8
-        
-        # Month names in different languages
-        months_fr = ["", "Janvier", "Février", "Mars", "Avril", "Mai", "Juin", 
-                    "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
-        months_en = ["", "January", "February", "March", "April", "May", "June",
-                    "July", "August", "September", "October", "November", "December"] 
-        months_es = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
-                    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-        
-        # Get month name in correct language
-        if is_fr:
-            month_name = months_fr[mois_selectionne]
-        elif is_es:
-            month_name = months_es[mois_selectionne]
-        else:  # Default to English
-            month_name = months_en[mois_selectionne]
-        
-        # Write month information to specific cells
-        # Q3 = Column 17, Row 3 (Month name)
-        ws.cell(row=3, column=17, value=month_name)
-        # Q4 = Column 17, Row 4 (Month number)
-        ws.cell(row=4, column=17, value=mois_selectionne)
-        # Q5 = Column 17, Row 5 (Year)
-        ws.cell(row=5, column=17, value=annee_selectionnee)
-        
-        # Write headers
-        for col_idx, col_name in enumerate(df_repartition.columns, start=1):
-            ws.cell(row=start_row, column=col_idx, value=col_name)
-        
-        # Day abbreviations in different languages
-        day_abbr_fr = ['Lun', 'Mar', 'Mer', 'Jeu', 'Ven', 'Sam', 'Dim']
-        day_abbr_en = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-        day_abbr_es = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
-        
-        # Determine language from existing global variables (if available)
-        try:
-            if 'is_fr' in globals() and is_fr:
-                day_abbr = day_abbr_fr
-            elif 'is_en' in globals() and is_en:
-                day_abbr = day_abbr_en
-            elif 'is_es' in globals() and is_es:
-                day_abbr = day_abbr_es
-            else:
-                day_abbr = day_abbr_en  # Default to English
-        except:
-            day_abbr = day_abbr_en  # Fallback to English
-        
-        # Write date numbers in row 7 and day abbreviations in row 8 for date columns
-        # (skip first 3 columns: Donor, Financing Code, Project)
-        for col_idx, col_name in enumerate(df_repartition.columns[3:], start=4):
-            try:
-                # Parse the date string
-                date_obj = datetime.strptime(col_name, "%Y-%m-%d")
-                # Write day number in row 7
-                day_number = date_obj.day  # Get the day of the month (1-31)
-                ws.cell(row=7, column=col_idx, value=day_number)
-                # Write day abbreviation in row 8
-                day_index = date_obj.weekday()  # 0=Monday, 6=Sunday
-                ws.cell(row=8, column=col_idx, value=day_abbr[day_index])
-                
-                # If it's a weekend (Saturday=5 or Sunday=6), set red background for rows 9-16
-                if day_index >= 5:  # Saturday or Sunday
-                    from openpyxl.styles import PatternFill
-                    red_fill = PatternFill(start_color="FFCCCC", end_color="FFCCCC", fill_type="solid")
-                    for row_num in range(7, 17):  # rows 9 to 16
-                        ws.cell(row=row_num, column=col_idx).fill = red_fill
-                        
-            except:
-                # If it's not a date column, skip it
-                pass
-        
-        # Write data
-        for row_idx, (index, row_data) in enumerate(df_repartition.iterrows(), start=start_row + 1):
-            for col_idx, value in enumerate(row_data, start=1):
-                ws.cell(row=row_idx, column=col_idx, value=value)
-        
-        # Set column width for date columns
-        # Skip first 3 columns: Donor, Financing Code, Project
-        for col_idx, col_name in enumerate(df_repartition.columns[3:], start=4):
-            try:
-                # Check if it's a date column
-                datetime.strptime(col_name, "%Y-%m-%d")
-                # Set column width
-                ws.column_dimensions[ws.cell(row=1, column=col_idx).column_letter].width = 4.77
-            except:
-                # If it's not a date column, skip it
-                pass
-        
-        # Set column width for column Q (5) to properly display year information
-        ws.column_dimensions['Q'].width = 5
-        
-        # Set print settings: landscape orientation and fit to width
-        ws.page_setup.orientation = ws.ORIENTATION_LANDSCAPE
-        ws.page_setup.fitToWidth = 1
-        ws.page_setup.fitToHeight = False  # Allow multiple pages vertically if needed
-        
-        # Save to BytesIO
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        return output
-        
-    except FileNotFoundError:
-        st.warning("Template 'Trame timesheet.xlsx' not found. Creating new file...")
-        # Fallback to original method if template not found
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df_repartition.to_excel(writer, sheet_name="Planning", index=False, startrow=7)
-        output.seek(0)
-        return output
+# Every interaction reruns this script, so it only does cheap work itself:
+# the template workbook and the parsed upload are cached (st.cache_data),
+# and pandas, planning (numpy, openpyxl) and travaux are imported where
+# they are first needed, so the page renders before they are loaded.
 
 # =============================
 # Language toggle (flags)
@@ -222,6 +25,18 @@ LANGUAGES = {
 lang_labels = [f"{LANGUAGES[l]} {l}" for l in LANGUAGES]
 lang_map = dict(zip(lang_labels, LANGUAGES.keys()))
 
+# Must be the first Streamlit call; the radio below has not run yet, so the
+# title's language comes from its value in the session state
+langue_page = lang_map.get(st.session_state.get("langue"), "Français")
+st.set_page_config(
+    page_title=(
+        "Générateur de Planning" if langue_page == "Français" else
+        "Timesheet Generator" if langue_page == "English" else
+        "Generador de Horarios"
+    ),
+    layout="centered"
+)
+
 st.markdown(
     """
     <style>
@@ -235,7 +50,8 @@ selected_lang_label = st.radio(
     label="Language Selection",
     options=lang_labels,
     horizontal=True,
-    label_visibility="hidden"
+    label_visibility="hidden",
+    key="langue"
 )
 lang = lang_map[selected_lang_label]
 is_fr = lang == "Français"
@@ -243,56 +59,145 @@ is_en = lang == "English"
 is_es = lang == "Español"
 
 # Initialize session state
-if 'zip_data' not in st.session_state:
-    st.session_state.zip_data = None
+# Background generation job (see travaux.py); also kept in the URL so a page
+# refresh finds it again
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = st.query_params.get("job")
+# Content hash of the upload the current job was generated from
+if 'zip_source' not in st.session_state:
+    st.session_state.zip_source = None
+# Generated sheet contents by cle_ligne: re-uploading a corrected file only
+# regenerates the rows that changed
+if 'cache_feuilles' not in st.session_state:
+    st.session_state.cache_feuilles = {}
+
+def job_en_cours():
+    import travaux
+    travail = travaux.etat(st.session_state.job_id) if st.session_state.job_id else None
+    return travail is not None and travail["etat"] in ("en_attente", "en_cours")
+
+def supprimer_zip():
+    # The generated ZIP lives with its job on disk, not in session memory
+    import travaux
+    if st.session_state.job_id:
+        travaux.oublier(st.session_state.job_id)
+    st.session_state.job_id = None
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+@st.cache_data(show_spinner=False)
+def modele_excel(is_fr, is_en, is_es):
+    # Template workbook bytes, built once per language for the whole server
+    import pandas as pd
+    from planning import nom_feuille_calendriers
+    template = BytesIO()
+    df_template = pd.DataFrame({
+        "Année" if is_fr else "Year" if is_en else "Año": [2025],
+        "Mois" if is_fr else "Month" if is_en else "Mes": [10],
+        "Heures par jour" if is_fr else "Hours per day" if is_en else "Horas por día": [8],
+        "Jours fériés" if is_fr else "Holidays" if is_en else "Días festivos": ["2025-10-15"],
+        "Contrats" if is_fr else "Contracts" if is_en else "Contratos": ["Contract1:50,Contract2:50"],
+        "Bailleurs" if is_fr else "Donors" if is_en else "Donarios": ["Donor1,Donor2"],
+        "Calendrier" if is_fr else "Calendar" if is_en else "Calendario": ["Bureau" if is_fr else "Office" if is_en else "Oficina"],
+        "Employé" if is_fr else "Employee" if is_en else "Empleado": ["Jane Doe"],
+    })
+    # Named holiday calendars, shared by every row that names them
+    df_calendriers = pd.DataFrame({
+        "Nom" if is_fr else "Name" if is_en else "Nombre": ["Bureau" if is_fr else "Office" if is_en else "Oficina"],
+        "Jours fériés" if is_fr else "Holidays" if is_en else "Días festivos": ["2025-10-01,2025-12-25"],
+    })
+    with pd.ExcelWriter(template, engine="openpyxl") as writer:
+        df_template.to_excel(writer, index=False)
+        df_calendriers.to_excel(writer, index=False, sheet_name=nom_feuille_calendriers(is_fr, is_en, is_es))
+    return template.getvalue()
+
+# Parsed uploads kept in the cache (a few files, for every session)
+NB_UPLOADS_CACHE = 8
+
+@st.cache_data(max_entries=NB_UPLOADS_CACHE, show_spinner=False)
+def analyser_upload(source, nom, is_fr, is_en, is_es, _contenu):
+    # Reads and validates an upload once per content hash (source) and
+    # language; _contenu is not hashed by Streamlit, source stands for it.
+    # Returns the preview (first block), the missing columns and, when none
+    # are missing, the validated table, its report, the parse time and the
+    # cost estimate of admission control.
+    import pandas as pd
+    import admission
+    from instrumentation import chrono
+    from planning import colonnes_requises, colonnes_manquantes, lire_upload, normaliser_blocs
+    # xlsx: every sheet, the rows plus the optional named holiday calendars;
+    # CSV and Parquet: read in blocks, the preview shows the first one
+    blocs, df_calendriers_upload = lire_upload(BytesIO(_contenu), nom, is_fr, is_en, is_es)
+    apercu = next(blocs, pd.DataFrame())
+    analyse = {
+        "apercu": apercu,
+        "requises": colonnes_requises(is_fr, is_en, is_es),
+        "manquantes": colonnes_manquantes(apercu, is_fr, is_en, is_es),
+        "table": None,
+        "rapport": None,
+        "temps": {},
+        "cout": None,
+    }
+    if not analyse["manquantes"]:
+        with chrono(analyse["temps"], "parse"):
+            analyse["table"], analyse["rapport"] = normaliser_blocs(itertools.chain([apercu], blocs), is_fr, is_en, is_es, df_calendriers_upload)
+        analyse["cout"] = admission.estimer_cout(analyse["table"])
+    return analyse
+
+def lire_fichier(chemin):
+    with open(chemin, "rb") as f:
+        return f.read()
+
+def afficher_pagine(df, cle, **options):
+    # Long tables are sent to the browser one page at a time
+    # (admission.LIGNES_APERCU rows)
+    import admission
+    nb = admission.nb_pages(len(df))
+    if nb == 1:
+        st.dataframe(df, **options)
+        return
+    numero = st.number_input(
+        f"Page (1-{nb})", min_value=1, max_value=nb, value=1, step=1, key=f"page_{cle}_{nb}"
+    )
+    st.dataframe(admission.page(df, numero), **options)
+    debut = (numero - 1) * admission.LIGNES_APERCU
+    st.caption(
+        f"Lignes {debut + 1} à {min(debut + admission.LIGNES_APERCU, len(df))} sur {len(df)}" if is_fr else
+        f"Rows {debut + 1} to {min(debut + admission.LIGNES_APERCU, len(df))} of {len(df)}" if is_en else
+        f"Filas {debut + 1} a {min(debut + admission.LIGNES_APERCU, len(df))} de {len(df)}"
+    )
 
 # =============================
 # Interface Streamlit
 # =============================
 
-st.set_page_config(
-    page_title=(
-        "Générateur de Planning" if is_fr else
-        "Timesheet Generator" if is_en else
-        "Generador de Horarios"
-    ),
-    layout="centered"
-)
-
 st.title(
     "📅 Générateur de planning d'heures" if is_fr else
     "📅 Timesheet Generator" if is_en else
     "📅 Generador de horarios"
 )
 
-template = BytesIO()
-df_template = pd.DataFrame({
-    "Année" if is_fr else "Year" if is_en else "Año": [2025],
-    "Mois" if is_fr else "Month" if is_en else "Mes": [10],
-    "Heures par jour" if is_fr else "Hours per day" if is_en else "Horas por día": [8],
-    "Jours fériés" if is_fr else "Holidays" if is_en else "Días festivos": ["2025-10-01,2025-10-15"],
-    "Contrats" if is_fr else "Contracts" if is_en else "Contratos": ["Contract1:50,Contract2:50"],
-    "Bailleurs" if is_fr else "Donors" if is_en else "Donarios": ["Donor1,Donor2"]
-})
-with pd.ExcelWriter(template, engine="openpyxl") as writer:
-    df_template.to_excel(writer, index=False)
-template.seek(0)
-
 st.markdown(
     (
         "ℹ️ [Comment utiliser le modèle Excel ?](#)<br>"
         "Cliquez sur le bouton ci-dessous pour télécharger un modèle Excel.<br>"
         "Remplissez chaque ligne avec vos paramètres (année, mois, heures par jour, jours fériés, contrats, donneurs).<br>"
+        "La colonne « Employé » (facultative) produit un classeur par employé et par année.<br>"
+        "Les jours fériés communs à plusieurs lignes peuvent être définis une fois dans la feuille « Calendriers » et référencés par la colonne « Calendrier ».<br>"
         "Ensuite, importez ce fichier pour générer automatiquement tous vos plannings."
         if is_fr else
         "ℹ️ [How to use the Excel template?](#)<br>"
         "Click the button below to download an Excel template.<br>"
         "Fill each row with your parameters (year, month, hours per day, holidays, contracts, donors).<br>"
+        "The optional 'Employee' column gives one workbook per employee and year.<br>"
+        "Holidays shared by several rows can be defined once in the 'Calendars' sheet and referenced in the 'Calendar' column.<br>"
         "Then, upload this file to automatically generate all your timesheets."
         if is_en else
         "ℹ️ [¿Cómo usar la plantilla de Excel?](#)<br>"
         "Haga clic en el botón de atras para descargar una plantilla de Excel.<br>"
         "Complete cada fila con sus parámetros (año, mes, horas por día, días festivos, contratos, donantes).<br>"
+        "La columna opcional «Empleado» genera un libro por empleado y año.<br>"
+        "Los días festivos comunes a varias filas pueden definirse una vez en la hoja «Calendarios» y referenciarse en la columna «Calendario».<br>"
         "Luego, suba este archivo para generar automáticamente todos sus horarios."
     ),
     unsafe_allow_html=True
@@ -304,7 +209,8 @@ st.download_button(
         "📥 Download Excel template" if is_en else
         "📥 Descargar plantilla Excel"
     ),
-    data=template,
+    # Built on the first click in each language, then served from the cache
+    data=functools.partial(modele_excel, is_fr, is_en, is_es),
     file_name=(
         "modele_plannings.xlsx" if is_fr else
         "timesheet_template.xlsx" if is_en else
@@ -316,210 +222,265 @@ st.download_button(
 
 # Upload multiple plannings
 st.subheader(
-    "Importer un fichier Excel pour générer les plannings annuels" if is_fr else
-    "Upload an Excel file to generate annual timesheets" if is_en else
-    "Subir un archivo Excel para generar los horarios anuales"
+    "Importer un fichier (Excel, CSV ou Parquet) pour générer les plannings annuels" if is_fr else
+    "Upload a file (Excel, CSV or Parquet) to generate annual timesheets" if is_en else
+    "Subir un archivo (Excel, CSV o Parquet) para generar los horarios anuales"
 )
-uploaded_file = st.file_uploader("Upload Excel File", type=["xlsx"], label_visibility="hidden")
+# Same list as planning.FORMATS_UPLOAD, without importing planning
+uploaded_file = st.file_uploader("Upload Excel File", type=["xlsx", "csv", "parquet"], label_visibility="hidden")
 
 if uploaded_file:
-    df_upload = pd.read_excel(uploaded_file)
+    contenu_upload = uploaded_file.getvalue()
+    source = hashlib.sha256(contenu_upload).hexdigest()
+    analyse = analyser_upload(source, uploaded_file.name, is_fr, is_en, is_es, contenu_upload)
+    df_upload = analyse["apercu"]
     st.write(
         "Aperçu du fichier importé :" if is_fr else
         "Preview of uploaded file:" if is_en else
         "Vista previa del archivo subido:"
     )
-    st.dataframe(df_upload)
-
-    # Initialize and reset session state for download files when new file is uploaded
-    st.session_state.zip_data = None
-    
-    if st.button(
-        "✅ Générer tous les plannings du fichier" if is_fr else
-        "✅ Generate all timesheets from file" if is_en else
-        "✅ Generar todos los horarios del archivo"
-    ):
-        year_col = "Année" if is_fr else "Year" if is_en else "Año"
-        
-        # Define all required columns based on language
-        month_col = "Mois" if is_fr else "Month" if is_en else "Mes"
-        hours_col = "Heures par jour" if is_fr else "Hours per day" if is_en else "Horas por día"
-        contracts_col = "Contrats" if is_fr else "Contracts" if is_en else "Contratos"
-        
-        required_columns = [year_col, month_col, hours_col, contracts_col]
-        missing_columns = [col for col in required_columns if col not in df_upload.columns]
-        
-        if missing_columns:
+    afficher_pagine(df_upload, "apercu")
+
+    # Reset the download only when a different file comes in, not on every
+    # rerun (a language switch keeps it too); a running job is never dropped
+    if st.session_state.zip_source != source and not job_en_cours():
+        supprimer_zip()
+        st.session_state.zip_source = source
+
+    required_columns = analyse["requises"]
+    missing_columns = analyse["manquantes"]
+
+    if missing_columns:
+        st.error(
+            f"❌ **Erreur : Colonnes manquantes dans le fichier**\n\n"
+            f"**Colonnes requises :** {', '.join(required_columns)}\n\n"
+            f"**Colonnes manquantes :** {', '.join(missing_columns)}\n\n"
+            f"**Colonnes disponibles :** {', '.join(df_upload.columns)}\n\n"
+            f"💡 **Solution :** Téléchargez le modèle Excel ci-dessus et utilisez-le comme format de référence." if is_fr else
+            f"❌ **Error: Missing columns in file**\n\n"
+            f"**Required columns:** {', '.join(required_columns)}\n\n"
+            f"**Missing columns:** {', '.join(missing_columns)}\n\n"
+            f"**Available columns:** {', '.join(df_upload.columns)}\n\n"
+            f"💡 **Solution:** Download the Excel template above and use it as a reference format." if is_en else
+            f"❌ **Error: Columnas faltantes en el archivo**\n\n"
+            f"**Columnas requeridas:** {', '.join(required_columns)}\n\n"
+            f"**Columnas faltantes:** {', '.join(missing_columns)}\n\n"
+            f"**Columnas disponibles:** {', '.join(df_upload.columns)}\n\n"
+            f"💡 **Solución:** Descargue la plantilla de Excel de arriba y úsela como formato de referencia."
+        )
+    else:
+        # Every row was validated up front (analyser_upload): one
+        # consolidated report instead of warnings trickling in during
+        # generation
+        table, rapport_validation = analyse["table"], analyse["rapport"]
+        nb_valides = int(table["valide"].sum())
+        nb_invalides = len(table) - nb_valides
+        if nb_invalides:
+            st.warning(
+                f"{nb_valides} ligne(s) valide(s), {nb_invalides} ligne(s) ignorée(s) :" if is_fr else
+                f"{nb_valides} valid row(s), {nb_invalides} row(s) will be skipped:" if is_en else
+                f"{nb_valides} fila(s) válida(s), {nb_invalides} fila(s) omitida(s):"
+            )
+            afficher_pagine(
+                rapport_validation.rename(columns={
+                    "ligne": "Ligne" if is_fr else "Row" if is_en else "Fila",
+                    "probleme": "Problème" if is_fr else "Problem" if is_en else "Problema",
+                }),
+                "rapport",
+                hide_index=True,
+            )
+        else:
+            st.info(
+                f"{nb_valides} ligne(s) valide(s)." if is_fr else
+                f"{nb_valides} valid row(s)." if is_en else
+                f"{nb_valides} fila(s) válida(s)."
+            )
+
+        # Admission control: estimated cost (rows x contracts x days) against
+        # the configured limits, before anything is generated
+        import admission
+        cout = analyse["cout"]
+        decision = admission.decider(cout)
+        if decision == "refus":
             st.error(
-                f"❌ **Erreur : Colonnes manquantes dans le fichier**\n\n"
-                f"**Colonnes requises :** {', '.join(required_columns)}\n\n"
-                f"**Colonnes manquantes :** {', '.join(missing_columns)}\n\n"
-                f"**Colonnes disponibles :** {', '.join(df_upload.columns)}\n\n"
-                f"💡 **Solution :** Téléchargez le modèle Excel ci-dessus et utilisez-le comme format de référence." if is_fr else
-                f"❌ **Error: Missing columns in file**\n\n"
-                f"**Required columns:** {', '.join(required_columns)}\n\n"
-                f"**Missing columns:** {', '.join(missing_columns)}\n\n"
-                f"**Available columns:** {', '.join(df_upload.columns)}\n\n"
-                f"💡 **Solution:** Download the Excel template above and use it as a reference format." if is_en else
-                f"❌ **Error: Columnas faltantes en el archivo**\n\n"
-                f"**Columnas requeridas:** {', '.join(required_columns)}\n\n"
-                f"**Columnas faltantes:** {', '.join(missing_columns)}\n\n"
-                f"**Columnas disponibles:** {', '.join(df_upload.columns)}\n\n"
-                f"💡 **Solución:** Descargue la plantilla de Excel de arriba y úsela como formato de referencia."
+                f"❌ Fichier trop volumineux : {cout['cellules']:,} cellules à générer (limite : {admission.LIMITE_CELLULES:,}). Découpez-le en plusieurs fichiers." if is_fr else
+                f"❌ File too large: {cout['cellules']:,} cells to generate (limit: {admission.LIMITE_CELLULES:,}). Split it into several files." if is_en else
+                f"❌ Archivo demasiado grande: {cout['cellules']:,} celdas a generar (límite: {admission.LIMITE_CELLULES:,}). Divídalo en varios archivos."
             )
-            st.stop()
-            
-        grouped = df_upload.groupby(year_col)
-        download_files = []
-
-        progress_bar = st.progress(0)
-        total_rows = len(df_upload)
-        processed_rows = 0
-
-        for year, group in grouped:
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                sheet_written = False
-                for idx, row in group.iterrows():
-                    try:
-                        mois = int(row["Mois"] if is_fr else row["Month"] if is_en else row["Mes"])
-                        heures_par_jour = int(row["Heures par jour"] if is_fr else row["Hours per day"] if is_en else row["Horas por día"])
-                        jours_feries = []
-                        jours_feries_col = "Jours fériés" if is_fr else "Holidays" if is_en else "Días festivos"
-                        if pd.notna(row.get(jours_feries_col, None)):
-                            for d in str(row[jours_feries_col]).split(","):
-                                d = d.strip()
-                                if d:
-                                    jours_feries.append(datetime.strptime(d, "%Y-%m-%d").date())
-                        contrats = {}
-                        donors = {}
-                        contrats_col = "Contrats" if is_fr else "Contracts" if is_en else "Contratos"
-                        donor_col = "Bailleurs" if is_fr else "Donors" if is_en else "Donarios"
-                        contrats_items = str(row[contrats_col]).split(",")
-                        donor_items = str(row.get(donor_col, "")).split(",")
-                        if len(donor_items) != len(contrats_items):
-                            st.warning(
-                                f"Ligne {idx+1} ignorée : nombre de donors ({len(donor_items)}) différent du nombre de contrats ({len(contrats_items)})" if is_fr else
-                                f"Row {idx+1} skipped: number of donors ({len(donor_items)}) does not match number of contracts ({len(contrats_items)})" if is_en else
-                                f"Fila {idx+1} omitida: número de donantes ({len(donor_items)}) diferente al número de contratos ({len(contrats_items)})"
-                            )
-                            continue
-                        for i, item in enumerate(contrats_items):
-                            code, pct = item.split(":")
-                            contrats[code.strip()] = float(pct.strip())
-                            donors[code.strip()] = donor_items[i].strip()
-                        st.write(f"Contrats parsed: {contrats}, sum: {sum(contrats.values())}")
-                        if sum(contrats.values()) != 100:
-                            st.warning(
-                                f"Ligne {idx+1} ignorée : la somme des pourcentages de contrats n'est pas 100 (somme: {sum(contrats.values())})" if is_fr else
-                                f"Row {idx+1} skipped: contract percentages do not sum to 100 (sum: {sum(contrats.values())})" if is_en else
-                                f"Fila {idx+1} omitida: los porcentajes de contratos no suman 100 (suma: {sum(contrats.values())})"
-                            )
-                            continue
-                        excel_file = generer_excel(mois, year, contrats, heures_par_jour, jours_feries, donors, is_fr, is_en, is_es)
-                        # Read the generated workbook and copy it to our output
-                        temp_wb = openpyxl.load_workbook(excel_file)
-                        temp_ws = temp_wb.active
-                        
-                        # Create new worksheet in our output with localized month name
-                        months_fr = ["", "Janvier", "Février", "Mars", "Avril", "Mai", "Juin", 
-                                    "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
-                        months_en = ["", "January", "February", "March", "April", "May", "June",
-                                    "July", "August", "September", "October", "November", "December"] 
-                        months_es = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
-                                    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-                        
-                        if is_fr:
-                            sheet_name = months_fr[mois]
-                        elif is_es:
-                            sheet_name = months_es[mois]
-                        else:  # Default to English
-                            sheet_name = months_en[mois]
-                        new_ws = writer.book.create_sheet(title=sheet_name)
-                        
-                        # Copy all data and formatting from template to new sheet
-                        for row in temp_ws.iter_rows():
-                            for cell in row:
-                                new_cell = new_ws.cell(row=cell.row, column=cell.column, value=cell.value)
-                                # Copy formatting if needed
-                                if cell.has_style:
-                                    new_cell.font = copy(cell.font)
-                                    new_cell.border = copy(cell.border)
-                                    new_cell.fill = copy(cell.fill)
-                                    new_cell.number_format = copy(cell.number_format)
-                                    new_cell.protection = copy(cell.protection)
-                                    new_cell.alignment = copy(cell.alignment)
-                        
-                        # Copy column dimensions from template
-                        for col_letter, col_dim in temp_ws.column_dimensions.items():
-                            new_ws.column_dimensions[col_letter].width = col_dim.width
-                        
-                        # Set print settings for the output sheet
-                        new_ws.page_setup.orientation = new_ws.ORIENTATION_LANDSCAPE
-                        new_ws.page_setup.fitToWidth = 1
-                        new_ws.page_setup.fitToHeight = 0  # Use 0 instead of False
-                        new_ws.sheet_properties.pageSetUpPr.fitToPage = True  # Enable fit to page mode
-                        
-                        sheet_written = True
-                    except Exception as e:
-                        st.warning(
-                            f"Ligne {idx+1} ignorée : {e}" if is_fr else
-                            f"Row {idx+1} skipped: {e}" if is_en else
-                            f"Fila {idx+1} omitida: {e}"
-                        )
-                    processed_rows += 1
-                    progress_bar.progress(processed_rows / total_rows)
-                if not sheet_written:
-                    pd.DataFrame({"Info": ["No valid rows"]}).to_excel(writer, sheet_name="Info", index=False)
-            output.seek(0)
-            download_files.append((year, output))
-
-        st.success(
-            "Tous les plannings ont été générés !" if is_fr else
-            "All timesheets have been generated!" if is_en else
-            "¡Todos los horarios han sido generados!"
-        )
+        else:
+            if decision == "flux":
+                st.info(
+                    f"Fichier volumineux ({cout['cellules']:,} cellules) : génération en mode flux, sans cache en mémoire." if is_fr else
+                    f"Large file ({cout['cellules']:,} cells): generated in streaming mode, without the in-memory cache." if is_en else
+                    f"Archivo grande ({cout['cellules']:,} celdas): generación en modo flujo, sin caché en memoria."
+                )
 
-        # Create ZIP file and store in session state
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for year, fileobj in download_files:
-                filename = (
-                    f"plannings_{year}.xlsx" if is_fr else
-                    f"timesheets_{year}.xlsx" if is_en else
-                    f"horarios_{year}.xlsx"
+            from planning import RECAPITULATIF_ANNUEL
+            recapitulatif = st.checkbox(
+                "Ajouter une feuille récapitulative par année (heures par contrat et par mois)" if is_fr else
+                "Add a yearly summary sheet (hours per contract and month)" if is_en else
+                "Añadir una hoja de resumen anual (horas por contrato y por mes)",
+                value=RECAPITULATIF_ANNUEL,
+                key="recapitulatif"
+            )
+            if st.button(
+                "✅ Générer tous les plannings du fichier" if is_fr else
+                "✅ Generate all timesheets from file" if is_en else
+                "✅ Generar todos los horarios del archivo",
+                disabled=nb_valides == 0 or job_en_cours()
+            ):
+                # Generation runs as a background job: reruns and page refreshes
+                # don't interrupt it, the status panel below polls it
+                import travaux
+                from planning import grouper_par_annee
+                supprimer_zip()
+                st.session_state.zip_source = source
+                st.session_state.job_id = travaux.soumettre(
+                    grouper_par_annee(table), is_fr, is_en, is_es, temps=analyse["temps"],
+                    cache=st.session_state.cache_feuilles if decision == "normal" else None,
+                    recapitulatif=recapitulatif
                 )
-                zipf.writestr(filename, fileobj.getvalue())
-        zip_buffer.seek(0)
-        
-        # Store zip data in session state
-        st.session_state.zip_data = zip_buffer.getvalue()
-
-    # Show download button only if zip data is available
-    if hasattr(st.session_state, 'zip_data') and st.session_state.zip_data is not None:
-        try:
+                st.query_params["job"] = st.session_state.job_id
+
+            def telecharger_grand_livre():
+                # Built on click, in a separate thread: numbers only, no workbook;
+                # allocated in blocks in streaming mode
+                from planning import grouper_par_annee, grand_livre, blocs_grand_livre, ecrire_grand_livre
+                groupes = grouper_par_annee(table)
+                tampon = BytesIO()
+                ecrire_grand_livre(blocs_grand_livre(groupes) if decision == "flux" else grand_livre(groupes), tampon, ".csv")
+                return tampon.getvalue()
+
             st.download_button(
                 label=(
-                    "📥 Télécharger tous les plannings (ZIP)" if is_fr else
-                    "📥 Download all timesheets (ZIP)" if is_en else
-                    "📥 Descargar todos los horarios (ZIP)"
+                    "📄 Télécharger le tableau des heures (CSV)" if is_fr else
+                    "📄 Download the hours table (CSV)" if is_en else
+                    "📄 Descargar la tabla de horas (CSV)"
                 ),
-                data=st.session_state.zip_data,
+                data=telecharger_grand_livre,
                 file_name=(
-                    "plannings_annuels.zip" if is_fr else
-                    "yearly_timesheets.zip" if is_en else
-                    "horarios_anuales.zip"
+                    "repartition_heures.csv" if is_fr else
+                    "allocation_ledger.csv" if is_en else
+                    "reparto_horas.csv"
                 ),
-                mime="application/zip",
-                key="download_timesheets_zip"
+                mime="text/csv",
+                disabled=nb_valides == 0,
+                key="download_grand_livre"
             )
-        except Exception as e:
-            st.error(
-                f"Erreur lors de la génération du téléchargement. Veuillez régénérer les plannings." if is_fr else
-                f"Error generating download. Please regenerate the timesheets." if is_en else
-                f"Error al generar la descarga. Por favor regenere los horarios."
-            )
-            # Clear the problematic zip data
-            st.session_state.zip_data = None
 
+def afficher_performance(rapport):
+    if rapport["lignes_cache"]:
+        st.info(
+            f"{rapport['lignes_cache']} ligne(s) sur {rapport['lignes']} reprise(s) du cache." if is_fr else
+            f"{rapport['lignes_cache']} of {rapport['lignes']} row(s) reused from the cache." if is_en else
+            f"{rapport['lignes_cache']} de {rapport['lignes']} fila(s) reutilizada(s) de la caché."
+        )
+    with st.expander("⏱️ Performance"):
+        st.write(
+            "Temps cumulé par étape (secondes) :" if is_fr else
+            "Cumulative time per stage (seconds):" if is_en else
+            "Tiempo acumulado por etapa (segundos):"
+        )
+        st.json({
+            "temps": rapport["temps"],
+            # Only with TIMESHEETS_PROFILE_MEMORY=1
+            **({"memoire": rapport["memoire"]} if rapport.get("memoire") else {}),
+            "octets": rapport["octets"],
+            "essais": rapport["essais"],
+        })
+        st.write(
+            "Lignes les plus lentes :" if is_fr else
+            "Slowest rows:" if is_en else
+            "Filas más lentas:"
+        )
+        st.dataframe(rapport["detail"])
+
+def afficher_job():
+    import travaux
+    travail = travaux.etat(st.session_state.job_id)
+    if travail is None:
+        st.session_state.job_id = None
+        return
+    if travail["etat"] in ("en_attente", "en_cours"):
+        st.progress(
+            travail["lignes_faites"] / max(travail["lignes_total"], 1),
+            text=(
+                f"Génération en cours : {travail['lignes_faites']} / {travail['lignes_total']} lignes" if is_fr else
+                f"Generating: {travail['lignes_faites']} / {travail['lignes_total']} rows" if is_en else
+                f"Generando: {travail['lignes_faites']} / {travail['lignes_total']} filas"
+            )
+        )
+        return
+    if travail["etat"] != "termine":
+        st.error(
+            f"La génération a échoué ({travail['message'] or travail['etat']}). Veuillez régénérer les plannings." if is_fr else
+            f"Generation failed ({travail['message'] or travail['etat']}). Please regenerate the timesheets." if is_en else
+            f"La generación falló ({travail['message'] or travail['etat']}). Por favor regenere los horarios."
+        )
+        return
+
+    for ligne, message in travail["erreurs"]:
+        st.warning(message)
+    # Allocation audit of the generated rows (see audit.py)
+    rapport_audit = travail["rapport"].get("audit")
+    if rapport_audit and not rapport_audit["ok"]:
+        st.error(
+            f"⚠️ Contrôle des répartitions : {rapport_audit['lignes_en_echec']} ligne(s) sur {rapport_audit['lignes']} en échec." if is_fr else
+            f"⚠️ Allocation audit: {rapport_audit['lignes_en_echec']} of {rapport_audit['lignes']} row(s) failed." if is_en else
+            f"⚠️ Control de los repartos: {rapport_audit['lignes_en_echec']} de {rapport_audit['lignes']} fila(s) con error."
+        )
+        st.dataframe(rapport_audit["exemples"], hide_index=True)
+    st.success(
+        "Tous les plannings ont été générés !" if is_fr else
+        "All timesheets have been generated!" if is_en else
+        "¡Todos los horarios han sido generados!"
+    )
+    afficher_performance(travail["rapport"])
 
+    try:
+        # Large batches come as several ZIP parts (TIMESHEETS_ZIP_PART_MB)
+        nb_parties = len(travail["zips"])
+        for numero, chemin in enumerate(travail["zips"], start=1):
+            partie = f" ({numero}/{nb_parties})" if nb_parties > 1 else ""
+            suffixe = f"_part{numero}" if nb_parties > 1 else ""
+            if not os.path.exists(chemin):
+                raise FileNotFoundError(chemin)
+            st.download_button(
+                label=(
+                    f"📥 Télécharger tous les plannings (ZIP){partie}" if is_fr else
+                    f"📥 Download all timesheets (ZIP){partie}" if is_en else
+                    f"📥 Descargar todos los horarios (ZIP){partie}"
+                ),
+                # Read on click, not on every rerun
+                data=functools.partial(lire_fichier, chemin),
+                file_name=(
+                    f"plannings_annuels{suffixe}.zip" if is_fr else
+                    f"yearly_timesheets{suffixe}.zip" if is_en else
+                    f"horarios_anuales{suffixe}.zip"
+                ),
+                mime="application/zip",
+                key=f"download_timesheets_zip{suffixe}"
+            )
+    except Exception as e:
+        st.error(
+            f"Erreur lors de la génération du téléchargement. Veuillez régénérer les plannings." if is_fr else
+            f"Error generating download. Please regenerate the timesheets." if is_en else
+            f"Error al generar la descarga. Por favor regenere los horarios."
+        )
+        # Clear the problematic zip file
+        supprimer_zip()
+
+@st.fragment(run_every=1)
+def suivre_job():
+    # Polls the running job every second without rerunning the whole page,
+    # then reruns it once to show the result
+    afficher_job()
+    if not job_en_cours():
+        st.rerun()
+
+# Job status, shown even after a page refresh (no upload in the new session)
+if st.session_state.job_id:
+    if job_en_cours():
+        suivre_job()
+    else:
+        afficher_job()
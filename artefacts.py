@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+
+# Disk-backed, content-addressed store for generated artifacts (the month
+# sheet contents of the yearly workbooks), shared by every session and
+# process of the server and surviving restarts. Entries are files named
+# after the SHA-256 of their key; the least recently used ones are evicted
+# once the directory grows past TIMESHEETS_CACHE_MAX_MB (0 disables the
+# store).
+#
+# Concurrency: entries are written to a temporary file then renamed into
+# place, so readers see either nothing or a complete entry; a hit refreshes
+# the file's mtime, which is the LRU clock. Eviction can run in several
+# processes at once: a file that vanishes under one of them is simply a miss.
+#
+# Safety: entries are bytes or JSON, never pickles, so a planted file cannot
+# run code in the server. The default directory is per user, created 0700,
+# and any directory is only used if it belongs to this user and nobody else
+# can write to it; otherwise the store is disabled with a warning.
+
+logger = logging.getLogger(__name__)
+
+REPERTOIRE_CACHE = os.environ.get(
+    "TIMESHEETS_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), f"timesheets_cache_{os.getuid()}" if hasattr(os, "getuid") else "timesheets_cache"),
+)
+TAILLE_MAX_CACHE = int(float(os.environ.get("TIMESHEETS_CACHE_MAX_MB", 256)) * 1024 * 1024)
+
+SUFFIXE = ".bin"
+
+# Bytes written by this process since its last eviction pass: the directory
+# is only scanned again once a tenth of the cap has been added
+_ecrits = {"octets": None}
+_lock = threading.Lock()
+# Directory found safe to use, checked once per process and directory
+_verifie = {"repertoire": None, "sur": False}
+
+def _repertoire_sur():
+    # Create REPERTOIRE_CACHE private if missing, then check that it is a
+    # real directory owned by this user and not writable by group or others
+    with _lock:
+        if _verifie["repertoire"] == REPERTOIRE_CACHE:
+            return _verifie["sur"]
+        sur = False
+        try:
+            os.makedirs(REPERTOIRE_CACHE, mode=0o700, exist_ok=True)
+            infos = os.lstat(REPERTOIRE_CACHE)
+            if not stat.S_ISDIR(infos.st_mode):
+                logger.warning("Artifact store disabled: %s is not a directory", REPERTOIRE_CACHE)
+            elif hasattr(os, "getuid") and infos.st_uid != os.getuid():
+                logger.warning("Artifact store disabled: %s belongs to another user", REPERTOIRE_CACHE)
+            elif hasattr(os, "getuid") and infos.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                logger.warning("Artifact store disabled: %s is writable by other users", REPERTOIRE_CACHE)
+            else:
+                sur = True
+        except OSError as e:
+            logger.warning("Artifact store disabled: cannot create %s: %s", REPERTOIRE_CACHE, e)
+        _verifie.update(repertoire=REPERTOIRE_CACHE, sur=sur)
+        return sur
+
+def actif():
+    return TAILLE_MAX_CACHE > 0 and _repertoire_sur()
+
+def empreinte(*parties):
+    # Key of an artifact: SHA-256 over its parts (str or bytes)
+    h = hashlib.sha256()
+    for partie in parties:
+        h.update(partie if isinstance(partie, bytes) else str(partie).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _chemin(espace, cle):
+    return os.path.join(REPERTOIRE_CACHE, espace, cle[:2], cle + SUFFIXE)
+
+def lire(espace, cle, decoder=None):
+    # Cached bytes, or None on a miss; decoder turns them back into a value
+    # (see lire_json)
+    if not actif():
+        return None
+    chemin = _chemin(espace, cle)
+    try:
+        with open(chemin, "rb") as f:
+            valeur = f.read()
+        if decoder is not None:
+            valeur = decoder(valeur)
+        os.utime(chemin)
+        return valeur
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # Truncated or unreadable entry: drop it and regenerate
+        logger.warning("Discarding unreadable cache entry %s: %s", chemin, e)
+        try:
+            os.remove(chemin)
+        except OSError:
+            pass
+        return None
+
+def ecrire(espace, cle, contenu):
+    # contenu: bytes (see ecrire_json for other values)
+    if not actif():
+        return
+    chemin = _chemin(espace, cle)
+    try:
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+        fd, temporaire = tempfile.mkstemp(dir=os.path.dirname(chemin), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(contenu)
+            taille = f.tell()
+        os.replace(temporaire, chemin)
+    except OSError as e:
+        # The store is an optimization: a full or read-only disk must not
+        # break generation
+        logger.warning("Cannot write cache entry %s: %s", chemin, e)
+        return
+    with _lock:
+        if _ecrits["octets"] is not None and _ecrits["octets"] + taille < TAILLE_MAX_CACHE // 10:
+            _ecrits["octets"] += taille
+            return
+        _ecrits["octets"] = 0
+    evincer()
+
+def lire_json(espace, cle):
+    return lire(espace, cle, json.loads)
+
+def ecrire_json(espace, cle, valeur):
+    # valeur: made of dicts with str keys, lists, str, int, float (NaN
+    # included) and None
+    try:
+        contenu = json.dumps(valeur, separators=(",", ":")).encode("utf-8")
+    except (TypeError, ValueError) as e:
+        logger.warning("Cannot encode cache entry %s/%s: %s", espace, cle, e)
+        return
+    ecrire(espace, cle, contenu)
+
+def evincer(taille_max=None):
+    # Delete the least recently used entries until the store fits in
+    # taille_max bytes. Returns the number of entries removed.
+    if not _repertoire_sur():
+        return 0
+    taille_max = TAILLE_MAX_CACHE if taille_max is None else taille_max
+    entrees = []
+    for racine, _, fichiers in os.walk(REPERTOIRE_CACHE):
+        for nom in fichiers:
+            chemin = os.path.join(racine, nom)
+            try:
+                stat = os.stat(chemin)
+            except FileNotFoundError:
+                continue
+            entrees.append((stat.st_mtime_ns, stat.st_size, chemin))
+    total = sum(taille for _, taille, _ in entrees)
+    supprimees = 0
+    for _, taille, chemin in sorted(entrees):
+        if total <= taille_max:
+            break
+        try:
+            os.remove(chemin)
+            supprimees += 1
+        except FileNotFoundError:
+            pass
+        total -= taille
+    if supprimees:
+        logger.debug("Evicted %d cache entries, %d bytes left", supprimees, total)
+    return supprimees
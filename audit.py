@@ -0,0 +1,118 @@
+import numpy as np
+
+import calendrier
+
+# Post-generation audit. Checks the allocation of a batch, the rows x
+# contracts x working-days array of hours that planning.repartir_lot
+# returns, in one vectorized pass:
+#   - "somme_jour": every working day of a row adds up to its hours per day
+#     (the historical sampler gives up after 1000 tries and keeps whatever
+#     it had);
+#   - "total_contrat": every contract's monthly total is within
+#     TOLERANCE_CONTRAT of its exact share (percentage x hours per day x
+#     working days), whatever rounding the targets went through;
+#   - "jours_non_ouvres": no hours past the month's working days, counted
+#     from the calendar rather than from the allocation (they would land on
+#     weekends and holidays, or nowhere), nor past the row's contracts;
+#   - "granularite": every value is a non-negative multiple of half an hour;
+#   - "allocation": the row could not be allocated at all (see
+#     echec_allocation).
+# The report holds failure counts per check and a few examples, and merges
+# across workbooks with fusionner.
+
+CONTROLES = ("somme_jour", "total_contrat", "jours_non_ouvres", "granularite", "allocation")
+# Largest gap allowed between a contract's total and its exact share: one
+# half-hour unit, the best a half-hour allocation can always reach
+TOLERANCE_CONTRAT = 0.5
+EPSILON = 1e-9
+# Failures described one by one in a report
+NB_EXEMPLES = 20
+
+def rapport_vide():
+    return {"lignes": 0, "lignes_en_echec": 0, "ok": True, "echecs": dict.fromkeys(CONTROLES, 0), "exemples": []}
+
+def auditer(lignes, tenseur, nb_exemples=NB_EXEMPLES):
+    # lignes: parsed upload rows (see planning.grouper_par_annee), in the
+    # order of the first axis of tenseur
+    rapport = rapport_vide()
+    if not lignes:
+        return rapport
+    tenseur = np.asarray(tenseur, dtype=float)
+    nb_lignes, max_contrats, max_jours = tenseur.shape
+    heures = np.array([ligne["heures_par_jour"] for ligne in lignes], dtype=float)
+    nb_contrats = np.array([len(ligne["contrats"]) for ligne in lignes])
+    nb_ouvres = np.array([
+        int(calendrier.mois_calendrier(ligne["mois"], ligne["annee"], ligne["jours_feries"])[2].sum())
+        for ligne in lignes
+    ])
+    pourcentages = np.zeros((nb_lignes, max_contrats))
+    pourcentages[np.arange(max_contrats)[None, :] < nb_contrats[:, None]] = np.fromiter(
+        (pct for ligne in lignes for pct in ligne["contrats"].values()), dtype=float, count=int(nb_contrats.sum())
+    )
+    jour_ouvre = np.arange(max_jours)[None, :] < nb_ouvres[:, None]
+    contrat_present = np.arange(max_contrats)[None, :] < nb_contrats[:, None]
+    cellule_valide = contrat_present[:, :, None] & jour_ouvre[:, None, :]
+
+    sommes = tenseur.sum(axis=1)
+    totaux = np.where(cellule_valide, tenseur, 0.0).sum(axis=2)
+    cibles = pourcentages / 100 * (heures * nb_ouvres)[:, None]
+    echecs = {
+        # (row, working day)
+        "somme_jour": jour_ouvre & (np.abs(sommes - heures[:, None]) > EPSILON),
+        # (row, contract)
+        "total_contrat": contrat_present & (np.abs(totaux - cibles) > TOLERANCE_CONTRAT + EPSILON),
+        # (row, contract, day)
+        "jours_non_ouvres": ~cellule_valide & (np.abs(tenseur) > EPSILON),
+        "granularite": (np.abs(tenseur * 2 - np.rint(tenseur * 2)) > EPSILON) | (tenseur < -EPSILON),
+    }
+
+    codes = [list(ligne["contrats"]) for ligne in lignes]
+    def code(i, c):
+        return codes[i][c] if c < len(codes[i]) else f"#{c + 1}"
+    details = {
+        "somme_jour": lambda i, d: f"working day {d + 1}: {sommes[i, d]:g} h instead of {heures[i]:g} h",
+        "total_contrat": lambda i, c: f"{code(i, c)}: {totaux[i, c]:g} h for a share of {cibles[i, c]:.2f} h",
+        "jours_non_ouvres": lambda i, c, d: f"{code(i, c)}: {tenseur[i, c, d]:g} h on day {d + 1}, past the month's {nb_ouvres[i]} working days",
+        "granularite": lambda i, c, d: f"{code(i, c)}, working day {d + 1}: {tenseur[i, c, d]:g} h",
+    }
+    en_echec = np.zeros(nb_lignes, dtype=bool)
+    for controle, masque in echecs.items():
+        rapport["echecs"][controle] = int(masque.sum())
+        en_echec |= masque.reshape(nb_lignes, -1).any(axis=1)
+        for position in zip(*np.nonzero(masque)):
+            if len(rapport["exemples"]) >= nb_exemples:
+                break
+            i = int(position[0])
+            rapport["exemples"].append({
+                "ligne": lignes[i]["ligne"],
+                "controle": controle,
+                "detail": details[controle](*map(int, position)),
+            })
+    rapport["lignes"] = nb_lignes
+    rapport["lignes_en_echec"] = int(en_echec.sum())
+    rapport["ok"] = not en_echec.any()
+    return rapport
+
+def echec_allocation(ligne, erreur):
+    # Report of a row whose allocation raised: it fails the audit on its own
+    # instead of aborting the batch's
+    rapport = rapport_vide()
+    rapport["lignes"] = rapport["lignes_en_echec"] = 1
+    rapport["ok"] = False
+    rapport["echecs"]["allocation"] = 1
+    rapport["exemples"].append({"ligne": ligne["ligne"], "controle": "allocation", "detail": str(erreur)})
+    return rapport
+
+def fusionner(rapports, nb_exemples=NB_EXEMPLES):
+    # One report for several (workbooks, blocks); None entries are skipped
+    total = rapport_vide()
+    for rapport in rapports:
+        if not rapport:
+            continue
+        total["lignes"] += rapport["lignes"]
+        total["lignes_en_echec"] += rapport["lignes_en_echec"]
+        total["ok"] = total["ok"] and rapport["ok"]
+        for controle, nombre in rapport["echecs"].items():
+            total["echecs"][controle] = total["echecs"].get(controle, 0) + nombre
+        total["exemples"].extend(rapport["exemples"][:nb_exemples - len(total["exemples"])])
+    return total
@@ -0,0 +1,137 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import chrono, rapport_performance, rss_mo, pic_rss_mo
+from planning import (
+    MODES_ALLOCATION, MODE_ALLOCATION, MOTEURS_ECRITURE, MOTEUR_ECRITURE,
+    noms_colonnes, get_all_days, parser_upload, generer_lot, ecrire_zip,
+)
+
+# Throughput benchmark of the generation pipeline on synthetic uploads.
+#   python benchmark.py --rows 50,500 --contracts 2,8 --holidays 0,0.1 -o bench.json
+# Every combination of the parameter lists is one scenario; each stage is
+# timed separately and reported as seconds and rows/sec, in JSON. Each
+# scenario runs in a fresh process, so its peak RSS is its own and not the
+# high-water mark of a larger scenario run before it.
+
+def upload_synthetique(nb_lignes, nb_contrats, densite_feries=0.05, heures_par_jour=8, seed=0, is_fr=False, is_en=True, is_es=False):
+    # Upload sheet in the df_template format: consecutive months from 2025,
+    # nb_contrats contracts with random percentages summing to 100 and about
+    # densite_feries of each month's weekdays declared as holidays
+    rng = np.random.default_rng(seed)
+    colonnes = noms_colonnes(is_fr, is_en, is_es)
+    lignes = []
+    for i in range(nb_lignes):
+        annee, mois = 2025 + i // 12, i % 12 + 1
+        jours = [d for d in get_all_days(mois, annee) if d.weekday() < 5]
+        nb_feries = int(round(len(jours) * densite_feries))
+        feries = sorted(rng.choice(len(jours), size=nb_feries, replace=False)) if nb_feries else []
+        pourcentages = rng.multinomial(100 - nb_contrats, np.ones(nb_contrats) / nb_contrats) + 1
+        lignes.append({
+            colonnes["annee"]: annee,
+            colonnes["mois"]: mois,
+            colonnes["heures"]: heures_par_jour,
+            colonnes["feries"]: ",".join(jours[j].isoformat() for j in feries),
+            colonnes["contrats"]: ",".join(f"FC{c:02d}:{p}" for c, p in enumerate(pourcentages, start=1)),
+            colonnes["donors"]: ",".join(f"Donor{c}" for c in range(1, nb_contrats + 1)),
+        })
+    return pd.DataFrame(lignes)
+
+def executer_scenario(nb_lignes, nb_contrats, densite_feries, heures_par_jour, mode=MODE_ALLOCATION, seed=0, moteur=MOTEUR_ECRITURE):
+    # Runs the real pipeline serially; stage times come from its own
+    # instrumentation (see instrumentation.py)
+    rss_depart = rss_mo()
+    fichier = BytesIO()
+    upload_synthetique(nb_lignes, nb_contrats, densite_feries, heures_par_jour, seed).to_excel(fichier, index=False)
+
+    temps_lot = {}
+    with chrono(temps_lot, "parse"):
+        fichier.seek(0)
+        groupes, erreurs = parser_upload(pd.read_excel(fichier), is_en=True)
+
+    with tempfile.TemporaryDirectory(prefix="timesheets_bench_") as repertoire:
+        resultats = generer_lot(groupes, is_en=True, mode=mode, workers=1, repertoire=repertoire, moteur=moteur)
+        zip_buffer = BytesIO()
+        with chrono(temps_lot, "zip"):
+            ecrire_zip(resultats, zip_buffer, is_en=True)
+
+    rapport = rapport_performance([mesures for _, _, _, mesures in resultats], temps_lot, zip_buffer.getbuffer().nbytes)
+    total = sum(rapport["temps"].values())
+    pic = pic_rss_mo()
+    return {
+        "rows": nb_lignes,
+        "contracts": nb_contrats,
+        "holiday_density": densite_feries,
+        "hours_per_day": heures_par_jour,
+        "mode": mode,
+        "writer": moteur,
+        "skipped_rows": len(erreurs) + sum(len(e) for _, _, e, _ in resultats),
+        "bytes": rapport["octets"],
+        "allocation_attempts": rapport["essais"],
+        "stages": {
+            stage: {"seconds": secondes, "rows_per_sec": round(nb_lignes / secondes, 1) if secondes else None}
+            for stage, secondes in rapport["temps"].items()
+        },
+        "total_seconds": round(total, 6),
+        "rows_per_sec": round(nb_lignes / total, 1) if total else None,
+        # The process's RSS when the scenario started (interpreter and
+        # imports) and its peak during the scenario; None where unavailable
+        "start_rss_mb": round(rss_depart, 1) if rss_depart is not None else None,
+        "peak_rss_mb": round(pic, 1) if pic is not None else None,
+    }
+
+def executer_scenario_isole(*args):
+    # executer_scenario in a fresh spawned process
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(executer_scenario, *args).result()
+
+def _liste(type_valeur):
+    return lambda texte: [type_valeur(v) for v in texte.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the timesheet generation pipeline on synthetic uploads.")
+    parser.add_argument("--rows", type=_liste(int), default=[12, 120], help="comma-separated row counts")
+    parser.add_argument("--contracts", type=_liste(int), default=[2, 8], help="comma-separated contract counts")
+    parser.add_argument("--holidays", type=_liste(float), default=[0.0, 0.1], help="comma-separated holiday densities")
+    parser.add_argument("--hours", type=_liste(int), default=[8], help="comma-separated whole hours per day")
+    parser.add_argument("--mode", choices=MODES_ALLOCATION, default=MODE_ALLOCATION, help="allocation engine")
+    parser.add_argument("--writer", choices=MOTEURS_ECRITURE, default=MOTEUR_ECRITURE, help="sheet writer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    # Measure generation itself, not hits in the shared artifact store; read
+    # by the scenario processes when they import artefacts
+    os.environ["TIMESHEETS_CACHE_MAX_MB"] = "0"
+
+    scenarios = [
+        executer_scenario_isole(nb_lignes, nb_contrats, densite, heures, args.mode, args.seed, args.writer)
+        for nb_lignes, nb_contrats, densite, heures in itertools.product(args.rows, args.contracts, args.holidays, args.hours)
+    ]
+    rapport = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": scenarios,
+    }
+    texte = json.dumps(rapport, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(texte + "\n")
+    else:
+        print(texte)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
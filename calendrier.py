@@ -0,0 +1,55 @@
+import calendar
+from functools import lru_cache
+
+import numpy as np
+
+# Working-day calendar. Each (year, holiday set) pair is computed once, for
+# the whole year, with numpy's business-day functions, and kept in an LRU
+# cache: every row of an upload that shares a year and a holiday calendar is
+# served from the same index instead of walking its month day by day.
+#
+# Holidays are passed as a frozenset of datetime.date so the set itself is
+# the cache key; rows parsed by planning.normaliser_upload already share one
+# frozenset per distinct holiday list.
+
+# Indexes kept per process (one per year and distinct holiday set)
+TAILLE_CACHE = 1024
+
+def _figer(valeurs):
+    # Read-only arrays: the indexes are shared by every caller
+    valeurs.flags.writeable = False
+    return valeurs
+
+@lru_cache(maxsize=TAILLE_CACHE)
+def _index(annee, jours_feries):
+    debut = np.datetime64(f"{annee:04d}-01-01", "D")
+    jours = debut + np.arange(366 if calendar.isleap(annee) else 365)
+    feries = np.array(sorted(jours_feries), dtype="datetime64[D]")
+    mois = jours.astype("datetime64[M]").astype(int) % 12
+    return {
+        "jours": tuple(jours.astype(object)),
+        # 0=Monday ... 6=Sunday, like date.weekday()
+        "semaine": _figer(((jours - np.datetime64("1970-01-05", "D")).astype(int) % 7).astype(np.int8)),
+        "ouvres": _figer(np.is_busday(jours, holidays=feries)),
+        # Offset of the first day of each month, plus the year's length
+        "debuts": tuple(np.searchsorted(mois, np.arange(13)).tolist()),
+    }
+
+def index_annee(annee, jours_feries=frozenset()):
+    # {"jours": every date of the year, "semaine": weekday of each day,
+    #  "ouvres": working-day bitmap, "debuts": month offsets}
+    return _index(annee, frozenset(jours_feries))
+
+def mois_calendrier(mois, annee, jours_feries=frozenset()):
+    # Days, weekdays and working-day mask of one month, as slices of the
+    # year index
+    index = index_annee(annee, jours_feries)
+    debut, fin = index["debuts"][mois - 1], index["debuts"][mois]
+    return list(index["jours"][debut:fin]), index["semaine"][debut:fin], index["ouvres"][debut:fin]
+
+def jours_mois(mois, annee):
+    return mois_calendrier(mois, annee)[0]
+
+def jours_ouvres(mois, annee, jours_feries=frozenset()):
+    jours, _, ouvres = mois_calendrier(mois, annee, jours_feries)
+    return [jour for jour, ouvre in zip(jours, ouvres) if ouvre]
@@ -0,0 +1,311 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+
+import artefacts
+import instrumentation
+import travaux
+from benchmark import upload_synthetique
+
+# Concurrent-session load test of the Streamlit app.
+#   python charge.py --sessions 8 --rows 120 --contracts 4 -o charge.json
+#   python charge.py --sessions 16 --max-p95 60 --min-rows-per-sec 20   -> regression gate
+# Each session is an AppTest of app.py on its own thread, the way the
+# Streamlit server runs every browser session's script on a thread of one
+# process, so the sessions share what real users share: the st.cache_data
+# caches, the background job pool (travaux.py) and the worker processes.
+# AppTest swaps a global runtime in and out around each run, so script runs
+# take turns (as they mostly do on a server, under the GIL); the jobs they
+# start run concurrently. A step's latency includes that wait.
+# A session loads the page, uploads a synthetic file
+# (benchmark.upload_synthetique, a different one per session unless
+# --same-file), clicks generate, reruns the page every --poll seconds until
+# its job is done, as the browser's polling does, then renders the download.
+# Reported in JSON: per session the latency of each step, the size of its
+# session state and the peak RSS seen while it ran; overall the latency
+# percentiles, throughput (sessions and rows per second) and the peak RSS of
+# the server process and of the generation workers.
+# Exit codes: 0 all sessions succeeded within the thresholds, 1 a session
+# failed or a threshold (--max-p95, --max-rerun-p95, --max-rss-mb,
+# --min-rows-per-sec) was exceeded.
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# Same labels as the app's language radio
+LANGUES = {"fr": "🇫🇷 Français", "en": "🇬🇧 English", "es": "🇪🇸 Español"}
+TYPES_MIME = {"xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "csv": "text/csv"}
+ETAPES = ("page", "upload", "submit", "job", "result", "total")
+CENTILES = (50, 90, 95, 99)
+# Seconds between two memory samples
+INTERVALLE_MEMOIRE = 0.1
+
+_verrou_script = threading.Lock()
+
+def _executer_script(at):
+    # One script run at a time (see above)
+    with _verrou_script:
+        return at.run()
+
+def _rss_processus(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / instrumentation.MO
+    except (OSError, ValueError):
+        return 0.0
+
+def echantillonner_memoire(releves, arret, intervalle=INTERVALLE_MEMOIRE):
+    # (time, server RSS, workers RSS) until arret is set; the workers are the
+    # process pool of planning.generer_lot (RSS read from /proc, 0 elsewhere)
+    while True:
+        releves.append((
+            time.perf_counter(),
+            instrumentation.rss_mo() or 0.0,
+            sum(_rss_processus(enfant.pid) for enfant in multiprocessing.active_children()),
+        ))
+        if arret.wait(intervalle):
+            return
+
+def _taille_etat(session_state):
+    # Pickled size of what the app keeps in the session; values that cannot
+    # be pickled are left out
+    octets = 0
+    for valeur in session_state.values():
+        try:
+            octets += len(pickle.dumps(valeur))
+        except Exception:
+            pass
+    return octets
+
+def executer_session(numero, nom, contenu, langue, poll, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    session = {"session": numero, "upload_bytes": len(contenu), "ok": False, "error": None, "latency": {}, "reruns": []}
+    latence = session["latency"]
+    debut = time.perf_counter()
+    session["start"] = debut
+    try:
+        at = AppTest.from_file(APP, default_timeout=timeout)
+        at.session_state["langue"] = LANGUES[langue]
+        t = time.perf_counter()
+        _executer_script(at)
+        latence["page"] = time.perf_counter() - t
+
+        at.file_uploader[0].set_value((nom, contenu, TYPES_MIME[os.path.splitext(nom)[1][1:]]))
+        t = time.perf_counter()
+        _executer_script(at)
+        latence["upload"] = time.perf_counter() - t
+        # The generate button is the only one whose label starts with ✅
+        boutons = [bouton for bouton in at.button if str(bouton.label).startswith("✅")]
+        if not boutons:
+            raise RuntimeError("no generate button after the upload: " + "; ".join(e.value for e in at.error))
+
+        boutons[0].click()
+        t = time.perf_counter()
+        _executer_script(at)
+        latence["submit"] = time.perf_counter() - t
+        job_id = at.session_state.job_id
+        if not job_id:
+            raise RuntimeError("no job submitted")
+
+        t_job = time.perf_counter()
+        while True:
+            travail = travaux.etat(job_id)
+            if travail is None or travail["etat"] not in ("en_attente", "en_cours"):
+                break
+            if time.perf_counter() - t_job > timeout:
+                raise RuntimeError(f"job {job_id} still running after {timeout} s")
+            time.sleep(poll)
+            t = time.perf_counter()
+            _executer_script(at)
+            session["reruns"].append(time.perf_counter() - t)
+        latence["job"] = time.perf_counter() - t_job
+        if travail is None or travail["etat"] != "termine":
+            raise RuntimeError(f"job {job_id} ended as {travail and travail['etat']}: {travail and travail['message']}")
+        session["rows"] = travail["lignes_total"]
+        session["queued_seconds"] = travail["debut"] - travail["soumis"]
+        session["zip_bytes"] = travail["rapport"]["octets"]["zip"] if travail["rapport"] else None
+        session["job_memory"] = (travail["rapport"] or {}).get("memoire") or None
+
+        t = time.perf_counter()
+        _executer_script(at)
+        latence["result"] = time.perf_counter() - t
+        if not at.get("download_button"):
+            raise RuntimeError("no download button once the job is done")
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        session["session_state_bytes"] = _taille_etat(at.session_state)
+        session["ok"] = True
+    except Exception as e:
+        session["error"] = f"{type(e).__name__}: {e}"
+    session["end"] = time.perf_counter()
+    latence["total"] = session["end"] - debut
+    return session
+
+def centiles(valeurs):
+    if not valeurs:
+        return None
+    valeurs = np.asarray(valeurs, dtype=float)
+    resume = {f"p{c}": round(float(np.percentile(valeurs, c)), 4) for c in CENTILES}
+    resume["mean"] = round(float(valeurs.mean()), 4)
+    resume["max"] = round(float(valeurs.max()), 4)
+    return resume
+
+def verifier_seuils(rapport, args):
+    # (check, measured, threshold, ok) for every threshold given
+    controles = [("failed_sessions", rapport["failed_sessions"], 0, rapport["failed_sessions"] == 0)]
+    total = rapport["latency"]["total"]
+    reruns = rapport["latency"]["rerun"]
+    if args.max_p95 is not None and total:
+        controles.append(("total_p95_seconds", total["p95"], args.max_p95, total["p95"] <= args.max_p95))
+    if args.max_rerun_p95 is not None and reruns:
+        controles.append(("rerun_p95_seconds", reruns["p95"], args.max_rerun_p95, reruns["p95"] <= args.max_rerun_p95))
+    if args.max_rss_mb is not None:
+        pic = rapport["memory"]["peak_total_rss_mb"]
+        controles.append(("peak_total_rss_mb", pic, args.max_rss_mb, pic <= args.max_rss_mb))
+    if args.min_rows_per_sec is not None and rapport["throughput"]["rows_per_sec"] is not None:
+        debit = rapport["throughput"]["rows_per_sec"]
+        controles.append(("rows_per_sec", debit, args.min_rows_per_sec, debit >= args.min_rows_per_sec))
+    return [{"check": nom, "measured": mesure, "threshold": seuil, "ok": ok} for nom, mesure, seuil, ok in controles]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the Streamlit app with concurrent sessions on synthetic uploads.")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions")
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds between two session starts")
+    parser.add_argument("--rows", type=int, default=24, help="rows of each synthetic upload")
+    parser.add_argument("--contracts", type=int, default=4, help="contracts per row")
+    parser.add_argument("--holidays", type=float, default=0.05, help="holiday density")
+    parser.add_argument("--format", choices=["xlsx", "csv"], default="xlsx", help="format of the uploads")
+    parser.add_argument("--lang", choices=list(LANGUES), default="en", help="language of the sessions and uploads")
+    parser.add_argument("--same-file", action="store_true", help="every session uploads the same file (shared caches hit)")
+    parser.add_argument("--keep-cache", action="store_true", help="keep the shared artifact store (see artefacts.py) enabled")
+    parser.add_argument("--job-workers", type=int, default=travaux.NB_TRAVAUX, help="background jobs running at the same time")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between two reruns while a job runs")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds allowed for one script run or one job")
+    parser.add_argument("--profile-memory", action="store_true", help="also record each job's memory peaks per stage (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p95", type=float, help="fail if the p95 of the end-to-end session time exceeds this many seconds")
+    parser.add_argument("--max-rerun-p95", type=float, help="fail if the p95 of the reruns during generation exceeds this many seconds")
+    parser.add_argument("--max-rss-mb", type=float, help="fail if the server and workers together exceed this peak RSS")
+    parser.add_argument("--min-rows-per-sec", type=float, help="fail if fewer rows than this are generated per second")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    # Setting session state outside a run, as the sessions do, warns every time
+    # (a filter, Streamlit resets the levels of its loggers)
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(lambda enregistrement: False)
+
+    # Environment read again by the spawned worker processes
+    if not args.keep_cache:
+        os.environ["TIMESHEETS_CACHE_MAX_MB"] = "0"
+        artefacts.TAILLE_MAX_CACHE = 0
+    if args.profile_memory:
+        os.environ["TIMESHEETS_PROFILE_MEMORY"] = "1"
+        instrumentation.PROFIL_MEMOIRE = True
+    travaux.NB_TRAVAUX = args.job_workers
+    is_fr, is_en, is_es = args.lang == "fr", args.lang == "en", args.lang == "es"
+
+    televersements = []
+    for numero in range(args.sessions):
+        if args.same_file and televersements:
+            televersements.append(televersements[0])
+            continue
+        df = upload_synthetique(args.rows, args.contracts, args.holidays, seed=args.seed + numero, is_fr=is_fr, is_en=is_en, is_es=is_es)
+        fichier = BytesIO()
+        if args.format == "csv":
+            df.to_csv(fichier, index=False)
+        else:
+            df.to_excel(fichier, index=False)
+        televersements.append((f"load_{numero}.{args.format}", fichier.getvalue()))
+
+    releves = []
+    arret = threading.Event()
+    echantillonneur = threading.Thread(target=echantillonner_memoire, args=(releves, arret), daemon=True)
+    sessions = [None] * args.sessions
+
+    def lancer(numero):
+        nom, contenu = televersements[numero]
+        sessions[numero] = executer_session(numero, nom, contenu, args.lang, args.poll, args.timeout)
+
+    with tempfile.TemporaryDirectory(prefix="timesheets_load_") as repertoire:
+        # Jobs and their ZIPs stay out of the server's own jobs directory
+        travaux.REPERTOIRE_TRAVAUX = repertoire
+        echantillonneur.start()
+        debut = time.perf_counter()
+        fils = []
+        for numero in range(args.sessions):
+            if numero and args.ramp:
+                time.sleep(args.ramp)
+            fils.append(threading.Thread(target=lancer, args=(numero,), name=f"session-{numero}"))
+            fils[-1].start()
+        for fil in fils:
+            fil.join()
+        duree = time.perf_counter() - debut
+        arret.set()
+        echantillonneur.join()
+
+    for session in sessions:
+        # Peak RSS of the server while the session ran (all sessions share it)
+        pendant = [serveur for t, serveur, _ in releves if session["start"] <= t <= session["end"]]
+        session["peak_server_rss_mb"] = round(max(pendant), 1) if pendant else None
+        session["start"] = round(session.pop("start") - debut, 4)
+        session["end"] = round(session.pop("end") - debut, 4)
+        session["latency"] = {etape: round(secondes, 4) for etape, secondes in session["latency"].items()}
+        session["reruns"] = [round(secondes, 4) for secondes in session["reruns"]]
+
+    reussies = [session for session in sessions if session["ok"]]
+    lignes = sum(session["rows"] for session in reussies)
+    rapport = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "sessions": args.sessions, "ramp": args.ramp, "rows": args.rows, "contracts": args.contracts,
+            "holidays": args.holidays, "format": args.format, "lang": args.lang, "same_file": args.same_file,
+            "keep_cache": args.keep_cache, "job_workers": args.job_workers, "poll": args.poll,
+        },
+        "wall_seconds": round(duree, 4),
+        "failed_sessions": len(sessions) - len(reussies),
+        "latency": {
+            **{etape: centiles([session["latency"][etape] for session in reussies]) for etape in ETAPES},
+            "rerun": centiles([secondes for session in reussies for secondes in session["reruns"]]),
+            "queued": centiles([session["queued_seconds"] for session in reussies]),
+        },
+        "throughput": {
+            "sessions_per_sec": round(len(reussies) / duree, 4) if duree else None,
+            "rows_per_sec": round(lignes / duree, 1) if duree else None,
+        },
+        "memory": {
+            "peak_server_rss_mb": round(max((serveur for _, serveur, _ in releves), default=0.0), 1),
+            "peak_workers_rss_mb": round(max((travailleurs for _, _, travailleurs in releves), default=0.0), 1),
+            "peak_total_rss_mb": round(max((serveur + travailleurs for _, serveur, travailleurs in releves), default=0.0), 1),
+            "max_session_state_mb": round(max((session["session_state_bytes"] for session in reussies), default=0) / instrumentation.MO, 3),
+        },
+        "sessions": sessions,
+    }
+    rapport["gate"] = verifier_seuils(rapport, args)
+    texte = json.dumps(rapport, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(texte + "\n")
+    else:
+        print(texte)
+    echecs = [controle for controle in rapport["gate"] if not controle["ok"]]
+    for controle in echecs:
+        print(f"{controle['check']}: {controle['measured']} (threshold {controle['threshold']})", file=sys.stderr)
+    for session in sessions:
+        if session["error"]:
+            print(f"session {session['session']}: {session['error']}", file=sys.stderr)
+    return 1 if echecs else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+import admission
+import instrumentation
+from instrumentation import chrono, rapport_performance, journaliser_rapport
+from planning import (
+    MODES_ALLOCATION, MODE_ALLOCATION, MOTEURS_ECRITURE, MOTEUR_ECRITURE, NB_WORKERS, TAILLE_PARTIE_ZIP, RECAPITULATIF_ANNUEL,
+    colonnes_manquantes, lire_upload, normaliser_blocs, grouper_par_annee, lignes_ignorees,
+    generer_lot, ecrire_zips, grand_livre, blocs_grand_livre, ecrire_grand_livre, auditer_lot,
+)
+
+# Headless entry point for scheduled runs:
+#   python cli.py plannings.xlsx -o sortie/            -> one xlsx per employee and year
+#   python cli.py plannings.csv -o plannings.zip --lang fr
+#   python cli.py plannings.csv -o sortie/ --calendars calendriers.csv
+#   python cli.py plannings.parquet --ledger heures.parquet   -> numbers only, no workbook
+# Exit codes: 0 all rows generated, 1 some rows skipped, 2 unusable input
+# (or refused by admission control, see admission.py), 3 allocation audit
+# failed (see audit.py): nothing is written.
+
+# Exit code of a failed audit
+CODE_AUDIT = 3
+
+logger = logging.getLogger("timesheets")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate yearly timesheets from an upload file (.xlsx, .csv or .parquet).")
+    parser.add_argument("entree", help="upload file in the template format (.xlsx, .csv or .parquet)")
+    parser.add_argument("-o", "--output", help="output directory, or a path ending in .zip")
+    parser.add_argument("--ledger", help="also write the flat allocation table (year, month, day, donor, financing code, hours) to this .csv or .parquet file")
+    parser.add_argument("--lang", choices=["fr", "en", "es"], default="en", help="language of the column names and sheets")
+    parser.add_argument("--calendars", help="named holiday calendars (.xlsx, .csv or .parquet), replacing the upload's own sheet")
+    parser.add_argument("--summary", action="store_true", default=RECAPITULATIF_ANNUEL, help="add a yearly summary sheet (contract totals by month) to each workbook")
+    parser.add_argument("--zip-part-mb", type=float, default=TAILLE_PARTIE_ZIP / (1024 * 1024), help="split the .zip output into parts of about this size (0 = one file)")
+    parser.add_argument("--workers", type=int, default=NB_WORKERS, help="worker processes (1 = serial)")
+    parser.add_argument("--mode", choices=MODES_ALLOCATION, default=MODE_ALLOCATION, help="allocation engine")
+    parser.add_argument("--writer", choices=MOTEURS_ECRITURE, default=MOTEUR_ECRITURE, help="sheet writer (xml = template XML filled directly)")
+    parser.add_argument("--perf-json", help="write the performance report (stage times, retries, bytes) to this JSON file")
+    parser.add_argument("--no-audit", action="store_true", help="skip the allocation audit run before anything is written")
+    parser.add_argument("--profile-memory", action="store_true", help="record the memory peaks of each stage in the performance report (slower)")
+    parser.add_argument("--max-cells", type=int, default=admission.LIMITE_CELLULES, help="refuse uploads above this many rows x contracts x days (0 = no limit)")
+    parser.add_argument("--stream-cells", type=int, default=admission.SEUIL_FLUX, help="above this many cells, write the ledger in blocks")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if not args.output and not args.ledger:
+        parser.error("nothing to write: give -o/--output, --ledger or both")
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    is_fr, is_en, is_es = args.lang == "fr", args.lang == "en", args.lang == "es"
+    if args.profile_memory:
+        # Also read by the worker processes, which import instrumentation anew
+        os.environ["TIMESHEETS_PROFILE_MEMORY"] = "1"
+        instrumentation.PROFIL_MEMOIRE = True
+
+    temps_lot = {}
+    memoire_lot = {}
+    try:
+        # CSV and Parquet come in blocks, parsed as they are read
+        blocs, calendriers = lire_upload(args.entree, None, is_fr, is_en, is_es)
+        premier = next(blocs, None)
+    except Exception as e:
+        logger.error("Cannot read %s: %s", args.entree, e)
+        return 2
+    if premier is None:
+        logger.error("No rows in %s", args.entree)
+        return 2
+    if args.calendars:
+        try:
+            # The calendars sheet of a workbook (named in the --lang language),
+            # otherwise the file's rows: a .csv or .parquet holds that sheet only
+            blocs_calendriers, calendriers = lire_upload(args.calendars, None, is_fr, is_en, is_es)
+            if calendriers is None:
+                calendriers = pd.concat(blocs_calendriers)
+        except Exception as e:
+            logger.error("Cannot read %s: %s", args.calendars, e)
+            return 2
+    missing_columns = colonnes_manquantes(premier, is_fr, is_en, is_es)
+    if missing_columns:
+        logger.error("Missing columns in %s: %s", args.entree, ", ".join(missing_columns))
+        return 2
+
+    try:
+        with chrono(temps_lot, "parse", memoire_lot):
+            table, _ = normaliser_blocs(itertools.chain([premier], blocs), is_fr, is_en, is_es, calendriers)
+    except Exception as e:
+        logger.error("Cannot read %s: %s", args.entree, e)
+        return 2
+    cout = admission.estimer_cout(table)
+    decision = admission.decider(cout, args.max_cells, args.stream_cells)
+    logger.info(
+        "Estimated cost: %d rows, %d workbooks, %d cells, ~%.0f MB (%s)",
+        cout["lignes"], cout["classeurs"], cout["cellules"], cout["octets"] / (1024 * 1024), decision,
+    )
+    if decision == "refus":
+        logger.error("Upload refused: %d cells above the limit of %d (--max-cells)", cout["cellules"], args.max_cells)
+        return 2
+    groupes = grouper_par_annee(table)
+    erreurs = lignes_ignorees(table, is_fr, is_en, is_es)
+
+    if not args.no_audit:
+        # Fail fast: the whole allocation is checked before any file is written
+        try:
+            with chrono(temps_lot, "audit", memoire_lot):
+                rapport_audit = auditer_lot(groupes, mode=args.mode)
+        except Exception as e:
+            logger.error("Allocation audit could not run: %s", e)
+            return 2
+        if not rapport_audit["ok"]:
+            logger.error(
+                "Allocation audit failed on %d of %d rows: %s",
+                rapport_audit["lignes_en_echec"], rapport_audit["lignes"],
+                ", ".join(f"{controle}={nombre}" for controle, nombre in rapport_audit["echecs"].items() if nombre),
+            )
+            for exemple in rapport_audit["exemples"]:
+                logger.error("Row %d, %s: %s", exemple["ligne"], exemple["controle"], exemple["detail"])
+            if args.perf_json:
+                with open(args.perf_json, "w", encoding="utf-8") as f:
+                    json.dump({"audit": rapport_audit}, f, indent=2)
+            return CODE_AUDIT
+        logger.info("Allocation audit passed (%d rows)", rapport_audit["lignes"])
+
+    if args.ledger:
+        # Straight from the allocation, no workbook involved; large uploads
+        # are allocated and written a block of rows at a time
+        with chrono(temps_lot, "ledger", memoire_lot):
+            nb_lignes = ecrire_grand_livre(
+                blocs_grand_livre(groupes, mode=args.mode) if decision == "flux" else grand_livre(groupes, mode=args.mode),
+                args.ledger,
+            )
+        logger.info("Wrote %d allocation lines to %s", nb_lignes, args.ledger)
+
+    resultats = []
+    octets_zip = None
+    # Workbooks are streamed to disk one at a time, never held in memory
+    if args.output and args.output.lower().endswith(".zip"):
+        with tempfile.TemporaryDirectory(prefix="timesheets_") as repertoire:
+            resultats = generer_lot(groupes, is_fr, is_en, is_es, mode=args.mode, workers=args.workers, repertoire=repertoire, moteur=args.writer, recapitulatif=args.summary)
+            with chrono(temps_lot, "zip", memoire_lot):
+                chemins = ecrire_zips(resultats, args.output, is_fr, is_en, is_es, int(args.zip_part_mb * 1024 * 1024))
+        octets_zip = sum(os.path.getsize(chemin) for chemin in chemins)
+        logger.info("Wrote %d workbooks to %s", len(resultats), ", ".join(chemins))
+    elif args.output:
+        os.makedirs(args.output, exist_ok=True)
+        resultats = generer_lot(groupes, is_fr, is_en, is_es, mode=args.mode, workers=args.workers, repertoire=args.output, moteur=args.writer, recapitulatif=args.summary)
+        for _, chemin, _, _ in resultats:
+            logger.info("Wrote %s", chemin)
+
+    rapport = rapport_performance([mesures for _, _, _, mesures in resultats], temps_lot, octets_zip, memoire_lot=memoire_lot)
+    if not args.no_audit:
+        # Covers every row, ledger-only runs included
+        rapport["audit"] = rapport_audit
+    journaliser_rapport(rapport)
+    if args.perf_json:
+        with open(args.perf_json, "w", encoding="utf-8") as f:
+            json.dump(rapport, f, indent=2)
+
+    for _, _, erreurs_annee, _ in resultats:
+        erreurs.extend(erreurs_annee)
+    for ligne, message in sorted(erreurs):
+        logger.warning(message)
+    return 1 if erreurs else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+import numbers
+import posixpath
+import re
+import zipfile
+from io import BytesIO
+from xml.sax.saxutils import escape, unescape
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.xml.functions import tostring
+
+# Raw-XML writer: fills the template's sheet XML directly instead of going
+# through openpyxl cells. The template is compiled once (compiler_trame):
+# every template cell becomes a ready-made XML fragment, in a normal and a
+# weekend variant, and the sheet XML around <sheetData> is kept as text. A
+# month sheet is then the template rows with the month's values spliced in,
+# and the workbook is the template's package with one sheet part per month;
+# theme, shared strings, printer settings and document properties are copied
+# unchanged.
+#
+# Differences with the template file, matching what the openpyxl writer does:
+# shared formulas are expanded per cell (the day headers that anchor them are
+# overwritten), cached formula results and calcChain.xml are dropped and the
+# workbook recalculates on load, and the weekend cells use extra cellXfs
+# entries: a copy of each template style with the weekend fill.
+
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+TYPE_FEUILLE = NS_REL + "/worksheet"
+TYPE_CALCCHAIN = NS_REL + "/calcChain"
+CT_FEUILLE = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+
+RE_ATTR = re.compile(r'([\w:]+)="([^"]*)"')
+RE_LIGNE = re.compile(r"<row\b[^>]*?/>|<row\b[^>]*>.*?</row>", re.S)
+RE_CELLULE = re.compile(r"<c\b[^>]*?/>|<c\b[^>]*>.*?</c>", re.S)
+RE_FORMULE = re.compile(r"<f\b([^>]*?)(?:/>|>(.*?)</f>)", re.S)
+RE_RELATION = re.compile(r"<Relationship\b[^>]*/>")
+RE_REF = re.compile(r"([A-Z]+)(\d+)")
+
+MARQUE_COLONNES = "\x00cols\x00"
+MARQUE_DIMENSION = "\x00dimension\x00"
+MARQUE_SELECTION = "\x00selection\x00"
+MARQUE_FEUILLES = "\x00sheets\x00"
+MARQUE_NOMS = "\x00names\x00"
+MARQUE_RELATIONS = "\x00relationships\x00"
+MARQUE_TYPES = "\x00types\x00"
+
+def _attributs(balise):
+    return dict(RE_ATTR.findall(balise))
+
+def _definir_attributs(balise, **valeurs):
+    # Set attributes on an opening (or empty) tag, keeping the others as is
+    for nom, valeur in valeurs.items():
+        if re.search(rf'\s{nom}="[^"]*"', balise):
+            balise = re.sub(rf'(\s{nom}=)"[^"]*"', rf'\1"{valeur}"', balise)
+        else:
+            fin = "/>" if balise.endswith("/>") else ">"
+            balise = balise[:-len(fin)] + f' {nom}="{valeur}"' + fin
+    return balise
+
+def _index_colonne(lettres):
+    index = 0
+    for lettre in lettres:
+        index = index * 26 + ord(lettre) - 64
+    return index
+
+def _cible(base, cible):
+    # Part name of a relationship target, relative to the source part
+    if cible.startswith("/"):
+        return cible[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), cible))
+
+def _relatif(base, partie):
+    return posixpath.relpath(partie, posixpath.dirname(base))
+
+def _renumeroter(partie, numero):
+    # xl/printerSettings/printerSettings1.bin -> ...printerSettings{numero}.bin
+    return re.sub(r"\d*(\.\w+)$", rf"{numero}\1", partie)
+
+def verifier_texte(texte):
+    # A cell string as openpyxl stores it: truncated to Excel's limit, and
+    # control characters (they would make the workbook unreadable) raise the
+    # same IllegalCharacterError, so both writers skip the row the same way
+    texte = texte[:32767]
+    if ILLEGAL_CHARACTERS_RE.search(texte):
+        raise IllegalCharacterError(f"{texte} cannot be used in worksheets.")
+    return texte
+
+def _chaine(texte):
+    espace = ' xml:space="preserve"' if texte != texte.strip() else ""
+    return f'<is><t{espace}>{escape(texte)}</t></is>'
+
+def cellule_xml(ref, style, valeur):
+    # One cell with a value, written the way openpyxl would store it: NaN,
+    # None and "" leave the cell empty (style only), a string starting with
+    # "=" is a formula
+    s = f' s="{style}"' if style else ""
+    if valeur is None or valeur == "" or (isinstance(valeur, float) and valeur != valeur):
+        return f'<c r="{ref}"{s}/>'
+    if isinstance(valeur, str):
+        valeur = verifier_texte(valeur)
+        if valeur.startswith("=") and len(valeur) > 1:
+            return f'<c r="{ref}"{s}><f>{escape(valeur[1:])}</f></c>'
+        return f'<c r="{ref}"{s} t="inlineStr">{_chaine(valeur)}</c>'
+    if isinstance(valeur, bool):
+        return f'<c r="{ref}"{s} t="b"><v>{int(valeur)}</v></c>'
+    if isinstance(valeur, numbers.Integral):
+        return f'<c r="{ref}"{s}><v>{int(valeur)}</v></c>'
+    return f'<c r="{ref}"{s}><v>{float(valeur)!r}</v></c>'
+
+def _compiler_cellules(xml_ligne, formules_partagees, nb_xfs):
+    # {column: (style, XML, weekend XML)} for the cells of one template row
+    cellules = {}
+    for xml_cellule in RE_CELLULE.findall(xml_ligne):
+        ouverture = re.match(r"<c\b[^>]*?/?>", xml_cellule).group(0)
+        attrs = _attributs(ouverture)
+        ref = attrs["r"]
+        style = int(attrs.get("s", 0))
+        formule = RE_FORMULE.search(xml_cellule)
+        if formule is not None:
+            attrs_f = _attributs(formule.group(1))
+            texte = unescape(formule.group(2) or "")
+            if attrs_f.get("t") == "shared":
+                if texte:
+                    formules_partagees[attrs_f["si"]] = ("=" + texte, ref)
+                else:
+                    maitre, origine = formules_partagees[attrs_f["si"]]
+                    texte = Translator(maitre, origin=origine).translate_formula(ref)[1:]
+            xml_cellule = cellule_xml(ref, style, "=" + texte)
+            ouverture = re.match(r"<c\b[^>]*?/?>", xml_cellule).group(0)
+        weekend = _definir_attributs(ouverture, s=style + nb_xfs) + xml_cellule[len(ouverture):]
+        cellules[_index_colonne(RE_REF.match(ref).group(1))] = (style, xml_cellule, weekend)
+    return cellules
+
+def _xfs_weekend(styles, fill_weekend):
+    # styles.xml with the weekend fill and, for each cellXfs entry n, a copy
+    # using that fill at index n + count. Returns the new XML and count.
+    fills = re.search(r'<fills count="(\d+)">(.*?)</fills>', styles, re.S)
+    id_fill = int(fills.group(1))
+    styles = styles.replace(
+        fills.group(0),
+        f'<fills count="{id_fill + 1}">{fills.group(2)}{tostring(fill_weekend.to_tree()).decode()}</fills>',
+    )
+    xfs = re.search(r'<cellXfs count="(\d+)">(.*?)</cellXfs>', styles, re.S)
+    entrees = re.findall(r"<xf\b[^>]*?/>|<xf\b[^>]*>.*?</xf>", xfs.group(2), re.S)
+    copies = []
+    for entree in entrees:
+        ouverture = re.match(r"<xf\b[^>]*?/?>", entree).group(0)
+        copies.append(_definir_attributs(ouverture, fillId=id_fill, applyFill=1) + entree[len(ouverture):])
+    styles = styles.replace(
+        xfs.group(0),
+        f'<cellXfs count="{2 * len(entrees)}">{xfs.group(2)}{"".join(copies)}</cellXfs>',
+    )
+    return styles, len(entrees)
+
+def compiler_trame(contenu, fill_weekend, lignes_weekend):
+    # contenu: bytes of the template xlsx. Returns the compiled template used
+    # by ouvrir_classeur; it is read-only and can be shared by threads.
+    with zipfile.ZipFile(BytesIO(contenu)) as z:
+        parties = {nom: z.read(nom) for nom in z.namelist()}
+
+    classeur = parties["xl/workbook.xml"].decode("utf-8")
+    rels_classeur = parties["xl/_rels/workbook.xml.rels"].decode("utf-8")
+    relations = [_attributs(r) for r in RE_RELATION.findall(rels_classeur)]
+    attrs_feuille = _attributs(re.search(r"<sheet\b[^>]*/>", classeur).group(0))
+    chemin_feuille = next(_cible("xl/workbook.xml", r["Target"]) for r in relations if r["Id"] == attrs_feuille["r:id"])
+    chemin_rels_feuille = posixpath.join(posixpath.dirname(chemin_feuille), "_rels", posixpath.basename(chemin_feuille) + ".rels")
+    feuille = parties[chemin_feuille].decode("utf-8")
+    styles, nb_xfs = _xfs_weekend(parties["xl/styles.xml"].decode("utf-8"), fill_weekend)
+
+    # Sheet XML around <sheetData>, with the page setup of mise_en_page.
+    # Markers are plain text replaced later (the XML contains braces).
+    debut_donnees = re.search(r"<sheetData\s*/>|<sheetData>", feuille)
+    fin_donnees = feuille.find("</sheetData>")
+    fin_donnees = debut_donnees.end() if fin_donnees < 0 else fin_donnees + len("</sheetData>")
+    avant = feuille[:debut_donnees.start()]
+    apres = feuille[fin_donnees:]
+    apres = re.sub(r"<pageSetup\b[^>]*/>", lambda m: _definir_attributs(m.group(0), orientation="landscape", fitToWidth=1, fitToHeight=0), apres)
+    avant = re.sub(r"<pageSetUpPr\b[^>]*/>", lambda m: _definir_attributs(m.group(0), fitToPage=1), avant)
+    colonnes = []
+    cols = re.search(r"<cols>(.*?)</cols>", avant, re.S)
+    if cols is not None:
+        for col in re.findall(r"<col\b[^>]*/>", cols.group(1)):
+            attrs = _attributs(col)
+            colonnes.append((int(attrs["min"]), int(attrs["max"]), col))
+        avant = avant.replace(cols.group(0), MARQUE_COLONNES)
+    else:
+        avant = re.sub(r"(<sheetFormatPr\b[^>]*/>)", lambda m: m.group(1) + MARQUE_COLONNES, avant)
+    avant = re.sub(r'<dimension ref="[^"]*"/>', f'<dimension ref="{MARQUE_DIMENSION}"/>', avant)
+    avant = avant.replace('tabSelected="1"', MARQUE_SELECTION)
+
+    # Rows: opening tag and cells, plus the whole row for rows left untouched
+    lignes = {}
+    formules_partagees = {}
+    for xml_ligne in RE_LIGNE.findall(feuille[debut_donnees.start():fin_donnees]):
+        ouverture = re.match(r"<row\b[^>]*?/?>", xml_ligne).group(0)
+        numero = int(_attributs(ouverture)["r"])
+        ouverture = re.sub(r'\sspans="[^"]*"', "", ouverture)
+        if ouverture.endswith("/>"):
+            ouverture = ouverture[:-2] + ">"
+        lignes[numero] = (ouverture, _compiler_cellules(xml_ligne, formules_partagees, nb_xfs))
+    statiques = {
+        numero: ouverture + "".join(xml for _, (_, xml, _) in sorted(cellules.items())) + "</row>"
+        for numero, (ouverture, cellules) in lignes.items()
+    }
+
+    # Parts of the sheet (printer settings...) are copied for every sheet;
+    # calcChain.xml goes, its cells no longer match
+    rels_feuille = parties.get(chemin_rels_feuille, b"").decode("utf-8")
+    cibles_feuille = [
+        _cible(chemin_feuille, r["Target"]) for r in map(_attributs, RE_RELATION.findall(rels_feuille))
+        if r.get("TargetMode") != "External"
+    ]
+    calcchain = [_cible("xl/workbook.xml", r["Target"]) for r in relations if r["Type"] == TYPE_CALCCHAIN]
+    for xml in RE_RELATION.findall(rels_classeur):
+        if _attributs(xml)["Type"] in (TYPE_FEUILLE, TYPE_CALCCHAIN):
+            rels_classeur = rels_classeur.replace(xml, "")
+    rels_classeur = rels_classeur.replace("</Relationships>", MARQUE_RELATIONS + "</Relationships>")
+
+    types = parties["[Content_Types].xml"].decode("utf-8")
+    surcharges = {}
+    for xml in re.findall(r"<Override\b[^>]*/>", types):
+        attrs = _attributs(xml)
+        partie = attrs["PartName"].lstrip("/")
+        if partie in [chemin_feuille, *calcchain, *cibles_feuille]:
+            surcharges[partie] = attrs["ContentType"]
+            types = types.replace(xml, "")
+    types = types.replace("</Types>", MARQUE_TYPES + "</Types>")
+
+    # Names local to the template sheet (print area) are repeated per sheet
+    classeur = re.sub(r"<calcPr\b[^>]*/>", lambda m: _definir_attributs(m.group(0), fullCalcOnLoad=1), classeur)
+    classeur = re.sub(r"<sheets>.*?</sheets>", MARQUE_FEUILLES, classeur, flags=re.S)
+    noms_globaux, noms_locaux = [], []
+    noms = re.search(r"<definedNames>(.*?)</definedNames>|<definedNames/>", classeur, re.S)
+    if noms is not None:
+        for nom in re.findall(r"<definedName\b[^>]*>.*?</definedName>", noms.group(1) or "", re.S):
+            if _attributs(re.match(r"<definedName\b[^>]*>", nom).group(0)).get("localSheetId") == "0":
+                noms_locaux.append(nom)
+            else:
+                noms_globaux.append(nom)
+        classeur = classeur.replace(noms.group(0), MARQUE_NOMS)
+    else:
+        classeur = classeur.replace(MARQUE_FEUILLES, MARQUE_FEUILLES + MARQUE_NOMS)
+
+    exclues = {"[Content_Types].xml", "xl/workbook.xml", "xl/_rels/workbook.xml.rels", "xl/styles.xml",
+               chemin_feuille, chemin_rels_feuille, *calcchain, *cibles_feuille}
+    return {
+        "nom_feuille": unescape(attrs_feuille["name"]),
+        "avant": avant,
+        "apres": apres,
+        "colonnes": colonnes,
+        "lignes": lignes,
+        "statiques": statiques,
+        "lignes_weekend": lignes_weekend,
+        "nb_xfs": nb_xfs,
+        "classeur": classeur,
+        "noms_globaux": noms_globaux,
+        "noms_locaux": noms_locaux,
+        "rels_classeur": rels_classeur,
+        "types": types,
+        "surcharges": surcharges,
+        "chemin_feuille": chemin_feuille,
+        "rels_feuille": rels_feuille,
+        "cibles_feuille": {cible: parties[cible] for cible in cibles_feuille},
+        "copiees": {nom: contenu for nom, contenu in parties.items() if nom not in exclues} | {"xl/styles.xml": styles.encode("utf-8")},
+    }
+
+def _colonnes_xml(trame, largeurs):
+    # <cols> of the template with the month's column widths
+    colonnes = list(trame["colonnes"])
+    for lettre, largeur in largeurs.items():
+        index = _index_colonne(lettre)
+        nouvelles = []
+        trouvee = False
+        for debut, fin, col in colonnes:
+            if not debut <= index <= fin:
+                nouvelles.append((debut, fin, col))
+                continue
+            trouvee = True
+            # Split a column range around the resized column
+            if debut < index:
+                nouvelles.append((debut, index - 1, _definir_attributs(col, max=index - 1)))
+            nouvelles.append((index, index, _definir_attributs(col, min=index, max=index, width=largeur, customWidth=1)))
+            if index < fin:
+                nouvelles.append((index + 1, fin, _definir_attributs(col, min=index + 1)))
+        if not trouvee:
+            nouvelles.append((index, index, f'<col min="{index}" max="{index}" width="{largeur}" customWidth="1"/>'))
+        colonnes = sorted(nouvelles)
+    return "<cols>" + "".join(col for _, _, col in colonnes) + "</cols>" if colonnes else ""
+
+def feuille_xml(trame, valeurs, colonnes_weekend, largeurs, selectionnee=False):
+    # Worksheet XML of one month: template rows with valeurs ({(row,
+    # column): value}) laid over them and the weekend fill on
+    # colonnes_weekend, as ecrire_feuille_streaming does
+    par_ligne = {}
+    for (ligne, colonne), valeur in valeurs.items():
+        par_ligne.setdefault(ligne, {})[colonne] = valeur
+    weekend = set(colonnes_weekend)
+    nb_xfs = trame["nb_xfs"]
+    lignes_xml = []
+    max_ligne = max_colonne = 0
+    for numero in sorted(set(trame["lignes"]) | set(par_ligne)):
+        ouverture, cellules = trame["lignes"].get(numero, (f'<row r="{numero}">', {}))
+        valeurs_ligne = par_ligne.get(numero, {})
+        colonnes_weekend_ligne = weekend if numero in trame["lignes_weekend"] else ()
+        if not valeurs_ligne and not colonnes_weekend_ligne:
+            lignes_xml.append(trame["statiques"].get(numero) or ouverture + "</row>")
+        else:
+            morceaux = [ouverture]
+            for colonne in sorted(set(cellules) | set(valeurs_ligne) | set(colonnes_weekend_ligne)):
+                style, xml, xml_weekend = cellules.get(colonne, (0, None, None))
+                est_weekend = colonne in colonnes_weekend_ligne
+                if colonne in valeurs_ligne:
+                    ref = f"{get_column_letter(colonne)}{numero}"
+                    morceaux.append(cellule_xml(ref, style + nb_xfs if est_weekend else style, valeurs_ligne[colonne]))
+                elif xml is not None:
+                    morceaux.append(xml_weekend if est_weekend else xml)
+                else:
+                    morceaux.append(f'<c r="{get_column_letter(colonne)}{numero}" s="{nb_xfs}"/>')
+            morceaux.append("</row>")
+            lignes_xml.append("".join(morceaux))
+        if cellules or valeurs_ligne:
+            max_ligne = numero
+            max_colonne = max([max_colonne, *cellules, *valeurs_ligne])
+    dimension = f"A1:{get_column_letter(max(max_colonne, 1))}{max(max_ligne, 1)}"
+    avant = (
+        trame["avant"]
+        .replace(MARQUE_COLONNES, _colonnes_xml(trame, largeurs))
+        .replace(MARQUE_DIMENSION, dimension)
+        .replace(MARQUE_SELECTION, 'tabSelected="1"' if selectionnee else "")
+    )
+    return (avant + "<sheetData>" + "".join(lignes_xml) + "</sheetData>" + trame["apres"]).encode("utf-8")
+
+def _feuille_simple_xml(lignes):
+    # Bare worksheet (no template) with plain rows, for the Info and summary sheets
+    lignes_xml = "".join(
+        f'<row r="{r}">' + "".join(cellule_xml(f"{get_column_letter(c)}{r}", 0, v) for c, v in enumerate(ligne, start=1)) + "</row>"
+        for r, ligne in enumerate(lignes, start=1)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f"<sheetData>{lignes_xml}</sheetData></worksheet>"
+    ).encode("utf-8")
+
+def ouvrir_classeur(trame, destination):
+    # destination: path or binary file. Sheets are compressed into the
+    # archive as they are added, nothing but their titles is kept.
+    return {
+        "trame": trame,
+        "zip": zipfile.ZipFile(destination, "w", zipfile.ZIP_DEFLATED),
+        "feuilles": [],  # (title, uses the template)
+    }
+
+def ajouter_feuille(classeur, titre, valeurs, colonnes_weekend, largeurs):
+    trame = classeur["trame"]
+    numero = len(classeur["feuilles"]) + 1
+    chemin = posixpath.join(posixpath.dirname(trame["chemin_feuille"]), f"sheet{numero}.xml")
+    classeur["zip"].writestr(chemin, feuille_xml(trame, valeurs, colonnes_weekend, largeurs, selectionnee=numero == 1))
+    rels = trame["rels_feuille"]
+    if rels:
+        for cible, contenu in trame["cibles_feuille"].items():
+            copie = _renumeroter(cible, numero)
+            classeur["zip"].writestr(copie, contenu)
+            for relation in RE_RELATION.findall(rels):
+                attrs = _attributs(relation)
+                if attrs.get("TargetMode") != "External" and _cible(trame["chemin_feuille"], attrs["Target"]) == cible:
+                    rels = rels.replace(relation, _definir_attributs(relation, Target=_relatif(chemin, copie)))
+        chemin_rels = posixpath.join(posixpath.dirname(chemin), "_rels", f"sheet{numero}.xml.rels")
+        classeur["zip"].writestr(chemin_rels, rels)
+    classeur["feuilles"].append((titre, True))
+
+def ajouter_feuille_simple(classeur, titre, lignes):
+    numero = len(classeur["feuilles"]) + 1
+    chemin = posixpath.join(posixpath.dirname(classeur["trame"]["chemin_feuille"]), f"sheet{numero}.xml")
+    classeur["zip"].writestr(chemin, _feuille_simple_xml(lignes))
+    classeur["feuilles"].append((titre, False))
+
+def _reference_feuille(titre):
+    return "'" + titre.replace("'", "''") + "'"
+
+def abandonner_classeur(classeur):
+    # Release the destination of a workbook that failed half-way; the
+    # archive is left without its workbook parts
+    classeur["zip"].close()
+
+def fermer_classeur(classeur):
+    # Workbook-level parts: sheet list, relationships, content types, names,
+    # then every template part that is copied as is
+    trame = classeur["trame"]
+    z = classeur["zip"]
+    dossier = posixpath.dirname(trame["chemin_feuille"])
+    feuilles_xml, relations_xml, types_xml, noms_xml = [], [], [], list(trame["noms_globaux"])
+    ancien = re.compile(r"(?:'" + re.escape(trame["nom_feuille"].replace("'", "''")) + r"'|" + re.escape(trame["nom_feuille"]) + r")!")
+    for numero, (titre, avec_trame) in enumerate(classeur["feuilles"], start=1):
+        chemin = posixpath.join(dossier, f"sheet{numero}.xml")
+        feuilles_xml.append(f'<sheet name="{escape(titre, {chr(34): "&quot;"})}" sheetId="{numero}" r:id="rIdFeuille{numero}"/>')
+        relations_xml.append(f'<Relationship Id="rIdFeuille{numero}" Type="{TYPE_FEUILLE}" Target="{_relatif("xl/workbook.xml", chemin)}"/>')
+        types_xml.append(f'<Override PartName="/{chemin}" ContentType="{CT_FEUILLE}"/>')
+        if not avec_trame:
+            continue
+        for cible in trame["cibles_feuille"]:
+            if cible in trame["surcharges"]:
+                types_xml.append(f'<Override PartName="/{_renumeroter(cible, numero)}" ContentType="{trame["surcharges"][cible]}"/>')
+        for nom in trame["noms_locaux"]:
+            nom = _definir_attributs(re.match(r"<definedName\b[^>]*>", nom).group(0), localSheetId=numero - 1) + nom[len(re.match(r"<definedName\b[^>]*>", nom).group(0)):]
+            noms_xml.append(ancien.sub(lambda m: escape(_reference_feuille(titre)) + "!", nom))
+    z.writestr("xl/workbook.xml", (
+        trame["classeur"]
+        .replace(MARQUE_FEUILLES, "<sheets>" + "".join(feuilles_xml) + "</sheets>")
+        .replace(MARQUE_NOMS, "<definedNames>" + "".join(noms_xml) + "</definedNames>" if noms_xml else "")
+    ))
+    z.writestr("xl/_rels/workbook.xml.rels", trame["rels_classeur"].replace(MARQUE_RELATIONS, "".join(relations_xml)))
+    z.writestr("[Content_Types].xml", trame["types"].replace(MARQUE_TYPES, "".join(types_xml)))
+    for nom, contenu in trame["copiees"].items():
+        z.writestr(nom, contenu)
+    z.close()
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import audit
+
+# Per-stage timing and allocation-retry counters for the generation pipeline.
+# Rows record their own stages (calendar, allocate, fill, write); the batch
+# adds parse, audit, save and zip, and each workbook its audit report (see
+# audit.py). rapport_performance folds everything into one
+# JSON-serialisable dict, shown in the app and logged by journaliser_rapport.
+#
+# Memory profiling is optional (TIMESHEETS_PROFILE_MEMORY=1, or --profile-memory
+# on the command line) because tracemalloc slows every allocation down: each
+# stage given a memoire dict then also records the peak of Python allocations
+# during the stage and the process RSS at its end, in MB, the largest value
+# seen per stage. Peaks are per process; two jobs running in the same server
+# process at once share them.
+
+logger = logging.getLogger("timesheets.perf")
+
+ETAPES = ("parse", "calendar", "allocate", "audit", "fill", "write", "save", "zip")
+
+PROFIL_MEMOIRE = os.environ.get("TIMESHEETS_PROFILE_MEMORY", "") not in ("", "0")
+
+MO = 1024 * 1024
+
+def rss_mo():
+    # Current resident set size; the peak where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MO
+    except (OSError, ValueError, AttributeError):
+        pass
+    return pic_rss_mo()
+
+def pic_rss_mo():
+    # Highest resident set size of this process so far, None where it cannot
+    # be read (Windows)
+    try:
+        with open("/proc/self/status") as f:
+            for ligne in f:
+                if ligne.startswith("VmHWM:"):
+                    return int(ligne.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / MO if sys.platform == "darwin" else maxrss / 1024
+
+def _noter_memoire(memoire, etape, python_mo, rss):
+    releve = memoire.setdefault(etape, {"python_mo": 0.0, "rss_mo": None})
+    releve["python_mo"] = round(max(releve["python_mo"], python_mo), 3)
+    if rss is not None:
+        releve["rss_mo"] = round(max(releve["rss_mo"] or 0.0, rss), 1)
+
+@contextmanager
+def chrono(temps, etape, memoire=None):
+    profiler = PROFIL_MEMOIRE and memoire is not None
+    if profiler:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        alloue = tracemalloc.get_traced_memory()[0]
+    debut = time.perf_counter()
+    try:
+        yield
+    finally:
+        temps[etape] = temps.get(etape, 0.0) + time.perf_counter() - debut
+        if profiler:
+            # Peak above what was already allocated when the stage started
+            _noter_memoire(memoire, etape, (tracemalloc.get_traced_memory()[1] - alloue) / MO, rss_mo())
+
+def mesure_ligne(ligne, annee):
+    return {
+        "ligne": ligne["ligne"],
+        "annee": annee,
+        "mois": ligne["mois"],
+        "contrats": len(ligne["contrats"]),
+        "essais": [],  # allocation attempts, one entry per working day
+        "cache": False,  # sheet reused from the session cache
+        "temps": {},
+    }
+
+def mesure_classeur(annee, employe=""):
+    # memoire: per-stage memory peaks, when profiling is on; audit: report
+    # of the rows allocated for this workbook
+    return {"annee": annee, "employe": employe, "octets": 0, "temps": {}, "memoire": {}, "audit": None, "lignes": []}
+
+def rapport_performance(mesures_classeurs, temps_lot=None, octets_zip=None, nb_lignes_max=20, memoire_lot=None):
+    # Stage times are summed over rows and workbooks: with a process pool they
+    # are cumulative CPU-side times, not wall-clock time. Memory peaks are
+    # the largest seen per stage, in any process.
+    temps = dict.fromkeys(ETAPES, 0.0)
+    for etape, secondes in (temps_lot or {}).items():
+        temps[etape] = temps.get(etape, 0.0) + secondes
+    memoire = {}
+    for source in [memoire_lot or {}] + [classeur.get("memoire", {}) for classeur in mesures_classeurs]:
+        for etape, releve in source.items():
+            _noter_memoire(memoire, etape, releve["python_mo"], releve["rss_mo"])
+    detail = []
+    for classeur in mesures_classeurs:
+        for etape, secondes in classeur["temps"].items():
+            temps[etape] = temps.get(etape, 0.0) + secondes
+        for mesure in classeur["lignes"]:
+            for etape, secondes in mesure["temps"].items():
+                temps[etape] = temps.get(etape, 0.0) + secondes
+            detail.append({
+                "ligne": mesure["ligne"],
+                "annee": mesure["annee"],
+                "employe": classeur.get("employe", ""),
+                "mois": mesure["mois"],
+                "contrats": mesure["contrats"],
+                "cache": mesure.get("cache", False),
+                "jours_ouvres": len(mesure["essais"]),
+                "essais_total": sum(mesure["essais"]),
+                "essais_max_jour": max(mesure["essais"], default=0),
+                "secondes": round(sum(mesure["temps"].values()), 6),
+                **{etape: round(secondes, 6) for etape, secondes in mesure["temps"].items()},
+            })
+    # Slowest rows first: those are the ones operators need to look at
+    detail.sort(key=lambda d: d["secondes"], reverse=True)
+    essais = [d["essais_total"] for d in detail]
+    return {
+        "lignes": len(detail),
+        "classeurs": len(mesures_classeurs),
+        "lignes_cache": sum(d["cache"] for d in detail),
+        "temps": {etape: round(secondes, 6) for etape, secondes in temps.items()},
+        "memoire": memoire,
+        "audit": audit.fusionner(classeur.get("audit") for classeur in mesures_classeurs),
+        "octets": {
+            "classeurs": sum(classeur["octets"] for classeur in mesures_classeurs),
+            "zip": octets_zip,
+        },
+        "essais": {
+            "total": sum(essais),
+            "max_jour": max((d["essais_max_jour"] for d in detail), default=0),
+            "jours": sum(d["jours_ouvres"] for d in detail),
+        },
+        "detail": detail[:nb_lignes_max] if nb_lignes_max else detail,
+    }
+
+def journaliser_rapport(rapport):
+    # One JSON object per log line: the batch summary, then its slowest rows
+    resume = {cle: valeur for cle, valeur in rapport.items() if cle != "detail"}
+    logger.info(json.dumps({"event": "batch", **resume}))
+    for ligne in rapport["detail"]:
+        logger.info(json.dumps({"event": "row", **ligne}))
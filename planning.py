@@ -0,0 +1,1332 @@
+import pandas as pd
+import numpy as np
+from io import BytesIO
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import openpyxl
+from copy import copy
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.worksheet import Worksheet
+import zipfile
+
+import artefacts
+import audit
+import calendrier
+import ecriture_xml
+from instrumentation import chrono, mesure_ligne, mesure_classeur
+
+# Library module: no Streamlit import here, problems are reported through
+# return values and logging so it can run headless (see cli.py).
+logger = logging.getLogger(__name__)
+
+# =============================
+# Fonctions auxiliaires
+# =============================
+
+# Both are served from the per-year working-day index (see calendrier.py)
+def get_all_days(mois, annee):
+    return calendrier.jours_mois(mois, annee)
+
+def get_jours_ouvres(mois, annee, jours_feries):
+    return calendrier.jours_ouvres(mois, annee, jours_feries)
+
+# Allocation modes: "vectorise" solves the whole month in one pass over
+# half-hour units, "dirichlet" keeps the historical per-day rejection sampler
+# so both outputs can be compared.
+MODES_ALLOCATION = ("vectorise", "dirichlet")
+MODE_ALLOCATION = "vectorise"
+
+def _repartir_unites_lot(totaux, pourcentages):
+    # Largest-remainder apportionment, one row per line of pourcentages
+    # (padded with NaN past each row's contracts): integer half-hour units per
+    # contract that always add up to the row's total exactly.
+    presents = ~np.isnan(pourcentages)
+    pourcentages = np.where(presents, pourcentages, 0.0)
+    # cumsum adds left to right whatever the padding, so a row gets the
+    # same quotas alone or in a batch
+    sommes = np.cumsum(pourcentages, axis=1)[:, -1:]
+    quotas = totaux[:, None] * pourcentages / sommes
+    unites = np.floor(quotas).astype(int)
+    reste = totaux - unites.sum(axis=1)
+    # Padding sorts last; ties keep contract order (stable sort)
+    ordre = np.argsort(np.where(presents, -(quotas - unites), np.inf), axis=1, kind="stable")
+    rangs = np.empty_like(ordre)
+    np.put_along_axis(rangs, ordre, np.arange(ordre.shape[1])[None, :].repeat(len(ordre), axis=0), axis=1)
+    return unites + (rangs < reste[:, None])
+
+def repartir_unites(total_unites, pourcentages):
+    return _repartir_unites_lot(np.array([total_unites]), np.asarray(pourcentages, dtype=float)[None, :])[0]
+
+def _repartition_vectorisee_lot(contrats, heures_par_jour, nb_jours_ouvres, graines, essais):
+    nb_lignes = len(contrats)
+    nb_contrats = np.array([len(c) for c in contrats])
+    max_contrats = max(nb_contrats.max(initial=0), 1)
+    max_jours = max(max(nb_jours_ouvres, default=0), 1)
+    jours_lignes = np.asarray(nb_jours_ouvres, dtype=int)
+    unites_par_jour = np.rint(np.asarray(heures_par_jour, dtype=float) * 2).astype(int)
+    pourcentages = np.full((nb_lignes, max_contrats), np.nan)
+    pourcentages[np.arange(max_contrats)[None, :] < nb_contrats[:, None]] = np.fromiter(
+        (pct for c in contrats for pct in c.values()), dtype=float, count=int(nb_contrats.sum())
+    )
+    unites_contrats = _repartir_unites_lot(unites_par_jour * jours_lignes, pourcentages)
+
+    # Lay every half-hour unit of every row out once: labels are the contract
+    # index, rows follow each other. Each row's units are shuffled by its own
+    # generator (the only per-row call), then each row's stream is cut into
+    # days: every day receives exactly its row's units per day and every
+    # contract exactly its target, without any retry.
+    etiquettes = np.repeat(np.tile(np.arange(max_contrats), nb_lignes), unites_contrats.ravel())
+    tailles = unites_contrats.sum(axis=1)
+    debuts = np.cumsum(tailles) - tailles
+    decalages = np.repeat(debuts, tailles)
+    ordre = np.concatenate(
+        [np.random.default_rng(graine).permutation(taille) for graine, taille in zip(graines, tailles.tolist())]
+        + [np.zeros(0, dtype=int)]
+    )
+    etiquettes = etiquettes[ordre + decalages]
+    lignes = np.repeat(np.arange(nb_lignes), tailles)
+    jours = (np.arange(etiquettes.size) - decalages) // np.maximum(unites_par_jour, 1)[lignes]
+    tenseur = np.bincount(
+        (lignes * max_contrats + etiquettes) * max_jours + jours,
+        minlength=nb_lignes * max_contrats * max_jours
+    ).reshape(nb_lignes, max_contrats, max_jours) / 2
+
+    heures_cibles = [
+        {code: int(unites) / 2 for code, unites in zip(c, unites_contrats[i])}
+        for i, c in enumerate(contrats)
+    ]
+    # A single pass: one attempt per day
+    for i, liste in enumerate(essais):
+        liste.extend([1] * int(jours_lignes[i]))
+    return heures_cibles, tenseur
+
+def _repartition_vectorisee(contrats, heures_par_jour, nb_jours_ouvres, rng, essais):
+    heures_cibles, tenseur = _repartition_vectorisee_lot(
+        [contrats], [heures_par_jour], [nb_jours_ouvres], [rng], [essais]
+    )
+    return heures_cibles[0], tenseur[0, :len(contrats), :nb_jours_ouvres]
+
+def _repartition_dirichlet(contrats, heures_par_jour, nb_jours_ouvres, rng, essais):
+    HEURES_TOTALES = nb_jours_ouvres * heures_par_jour
+    heures_cibles = {code: round(HEURES_TOTALES * pct / 100, 2) for code, pct in contrats.items()}
+    contrats_list = list(contrats.keys())
+    matrice = np.zeros((len(contrats_list), nb_jours_ouvres))
+    heures_restantes = heures_cibles.copy()
+
+    for jour in range(nb_jours_ouvres):
+        max_alloc = [min(heures_restantes[code], heures_par_jour) for code in contrats_list]
+        tries = 0
+        while True:
+            props = rng.dirichlet(np.ones(len(contrats_list)))
+            alloc = np.minimum(np.round(props * heures_par_jour * 2) / 2, max_alloc)
+            diff = heures_par_jour - alloc.sum()
+            tries += 1
+            if abs(diff) < 0.01:
+                break
+            idx = np.argmax(max_alloc)
+            if alloc[idx] + diff <= max_alloc[idx] and alloc[idx] + diff >= 0:
+                alloc[idx] += diff
+                break
+            # Add this line to see how many tries per day
+            if tries > 1000:
+                logger.warning("Allocation for working day %d took %d tries", jour + 1, tries)
+                break
+        essais.append(tries)
+        matrice[:, jour] = alloc
+        for idx, code in enumerate(contrats_list):
+            heures_restantes[code] -= alloc[idx]
+    return heures_cibles, matrice
+
+def repartir_heures(contrats, heures_par_jour, nb_jours_ouvres, mode=MODE_ALLOCATION, rng=None, essais=None):
+    # Returns the per-contract targets and a contracts x working-days matrix of hours.
+    # When a list is given as essais, the number of attempts each working
+    # day needed is appended to it.
+    if mode not in MODES_ALLOCATION:
+        raise ValueError(f"Unknown allocation mode: {mode}")
+    if rng is None:
+        rng = np.random.default_rng()
+    if essais is None:
+        essais = []
+    if mode == "dirichlet":
+        return _repartition_dirichlet(contrats, heures_par_jour, nb_jours_ouvres, rng, essais)
+    return _repartition_vectorisee(contrats, heures_par_jour, nb_jours_ouvres, rng, essais)
+
+def repartir_lot(contrats, heures_par_jour, nb_jours_ouvres, graines, mode=MODE_ALLOCATION, essais=None):
+    # Allocation of many rows at once (any mix of months, contract sets and
+    # hours): row i is described by contrats[i], heures_par_jour[i],
+    # nb_jours_ouvres[i] and graines[i] (seed or Generator). Returns the
+    # per-row targets and a rows x contracts x working-days array of hours,
+    # zero-padded: row i is tenseur[i, :len(contrats[i]), :nb_jours_ouvres[i]],
+    # the same matrix repartir_heures gives for that row and seed.
+    # essais: optional list of per-row lists receiving the attempts per day.
+    if mode not in MODES_ALLOCATION:
+        raise ValueError(f"Unknown allocation mode: {mode}")
+    if essais is None:
+        essais = [[] for _ in contrats]
+    if mode == "vectorise":
+        return _repartition_vectorisee_lot(contrats, heures_par_jour, nb_jours_ouvres, graines, essais)
+    # The historical sampler is sequential by nature: row by row
+    tenseur = np.zeros((len(contrats), max([len(c) for c in contrats], default=0), max(nb_jours_ouvres, default=0)))
+    heures_cibles = []
+    for i, (c, h, n, graine) in enumerate(zip(contrats, heures_par_jour, nb_jours_ouvres, graines)):
+        cibles, matrice = _repartition_dirichlet(c, h, n, np.random.default_rng(graine), essais[i])
+        heures_cibles.append(cibles)
+        tenseur[i, :len(c), :n] = matrice
+    return heures_cibles, tenseur
+
+# Template file contents, read once per process and keyed by the file's mtime
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Trame timesheet.xlsx")
+_template_cache = {}
+_template_lock = threading.Lock()
+
+def _entree_template(chemin):
+    mtime = os.stat(chemin).st_mtime_ns
+    with _template_lock:
+        entree = _template_cache.get(chemin)
+        if entree is None or entree["mtime"] != mtime:
+            with open(chemin, "rb") as f:
+                contenu = f.read()
+            entree = {"mtime": mtime, "contenu": contenu, "empreinte": hashlib.sha256(contenu).hexdigest(), "lecture": None, "xml": None}
+            _template_cache[chemin] = entree
+        return entree
+
+def charger_template(chemin=TEMPLATE_PATH):
+    # Raises FileNotFoundError when the template is missing.
+    # The file is read from disk only when its mtime changes; each caller
+    # parses its own workbook from the cached bytes, once, with no save and
+    # reload round-trip. Workbooks can't be deep-copied safely (openpyxl's
+    # style tables don't survive copy.deepcopy), so callers that only need
+    # to read the layout should use template_en_lecture instead.
+    return openpyxl.load_workbook(BytesIO(_entree_template(chemin)["contenu"]))
+
+def template_en_lecture(chemin=TEMPLATE_PATH):
+    # Parsed template shared by the whole process: the streaming writer reads
+    # its cells, styles and page layout. It must never be modified.
+    entree = _entree_template(chemin)
+    with _template_lock:
+        if entree["lecture"] is None:
+            entree["lecture"] = openpyxl.load_workbook(BytesIO(entree["contenu"]))
+        return entree["lecture"]
+
+def trame_xml(chemin=TEMPLATE_PATH):
+    # Template compiled for the raw-XML writer (see ecriture_xml.py), shared
+    # by the whole process like template_en_lecture
+    entree = _entree_template(chemin)
+    with _template_lock:
+        if entree["xml"] is None:
+            entree["xml"] = ecriture_xml.compiler_trame(entree["contenu"], WEEKEND_FILL, LIGNES_WEEKEND)
+        return entree["xml"]
+
+def empreinte_template(chemin=TEMPLATE_PATH):
+    # Hash of the template file, part of every cached artifact's key so a new
+    # template invalidates them; empty when the template is missing
+    try:
+        return _entree_template(chemin)["empreinte"]
+    except FileNotFoundError:
+        return ""
+
+# Localization tables shared by every generated sheet
+MOIS_FR = ["", "Janvier", "Février", "Mars", "Avril", "Mai", "Juin",
+           "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
+MOIS_EN = ["", "January", "February", "March", "April", "May", "June",
+           "July", "August", "September", "October", "November", "December"]
+MOIS_ES = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+           "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+JOURS_FR = ['Lun', 'Mar', 'Mer', 'Jeu', 'Ven', 'Sam', 'Dim']
+JOURS_EN = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+JOURS_ES = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
+
+# One fill object shared by every weekend cell instead of one per cell
+WEEKEND_FILL = PatternFill(start_color="FFCCCC", end_color="FFCCCC", fill_type="solid")
+
+def nom_mois(mois, is_fr=False, is_en=False, is_es=False):
+    if is_fr:
+        return MOIS_FR[mois]
+    elif is_es:
+        return MOIS_ES[mois]
+    return MOIS_EN[mois]  # Default to English
+
+def abreviations_jours(is_fr=False, is_en=False, is_es=False):
+    if is_fr:
+        return JOURS_FR
+    elif is_es:
+        return JOURS_ES
+    return JOURS_EN  # Default to English
+
+def contexte_annee(annee, is_fr=False, is_en=False, is_es=False):
+    # Everything the month sheets of one year share, built once per
+    # workbook instead of once per sheet: the localized month names and,
+    # per month, the template cells every sheet of that month fills (month
+    # name, number and year, day numbers and names, table headers), its
+    # weekend columns, column widths and number of calendar days. Working
+    # days depend on each row's holidays and are looked up per row
+    # (calendrier.jours_ouvres).
+    noms_mois = [nom_mois(mois, is_fr, is_en, is_es) for mois in range(13)]
+    day_abbr = abreviations_jours(is_fr, is_en, is_es)
+    contexte = {"annee": annee, "noms_mois": noms_mois, "mois": {}}
+    for mois in range(1, 13):
+        jours_mois, jours_semaine, _ = calendrier.mois_calendrier(mois, annee)
+        # Q3, Q4, Q5: month name, month number and year
+        base = {(3, 17): noms_mois[mois], (4, 17): mois, (5, 17): annee}
+        # Table headers on row 8: Donor, Financing Code, Project, then the days
+        for col_idx, titre in enumerate(["Donor", "Financing Code", ""], start=1):
+            base[(8, col_idx)] = titre
+        colonnes_weekend = []
+        largeurs = {}
+        # Day numbers on row 7 and day abbreviations on row 8, from column D
+        for col_idx, (date_obj, day_index) in enumerate(zip(jours_mois, jours_semaine.tolist()), start=4):
+            base[(7, col_idx)] = date_obj.day
+            base[(8, col_idx)] = day_abbr[day_index]
+            # day_index: 0=Monday, 6=Sunday; weekend columns get the red
+            # fill on LIGNES_WEEKEND
+            if day_index >= 5:
+                colonnes_weekend.append(col_idx)
+            largeurs[get_column_letter(col_idx)] = 4.77
+        # Column Q wide enough for the year
+        largeurs['Q'] = 5
+        contexte["mois"][mois] = {"base": base, "colonnes_weekend": colonnes_weekend, "largeurs": largeurs, "nb_jours": len(jours_mois)}
+    return contexte
+
+def contenu_feuille_annee(contexte, ligne, jours_ouvres, matrice):
+    # Everything a month sheet changes on top of the template, used by every
+    # writer: {(row, column): value}, the weekend columns and the column
+    # widths. The month's shared cells (see contexte_annee), the employee in
+    # C3 (next to "Name:"), then one line per contract from row 9 (donor,
+    # financing code, project, the allocation matrix on working days),
+    # weekends and holidays left as NaN
+    mois = contexte["mois"][ligne["mois"]]
+    valeurs = dict(mois["base"])
+    if ligne.get("employe"):
+        valeurs[(3, 3)] = ligne["employe"]
+    donors = ligne["donors"]
+    colonnes_ouvrees = [jour.day + 3 for jour in jours_ouvres]
+    for row_idx, (code, heures) in enumerate(zip(ligne["contrats"], np.asarray(matrice).tolist()), start=9):
+        valeurs[(row_idx, 1)] = donors.get(code, "") if donors else ""
+        valeurs[(row_idx, 2)] = code
+        valeurs[(row_idx, 3)] = ""
+        jours = [np.nan] * mois["nb_jours"]
+        for col_idx, valeur in zip(colonnes_ouvrees, heures):
+            jours[col_idx - 4] = valeur
+        for col_idx, valeur in enumerate(jours, start=4):
+            valeurs[(row_idx, col_idx)] = valeur
+    return valeurs, mois["colonnes_weekend"], mois["largeurs"]
+
+def _feuille_json(feuille):
+    # Sheet contents in the artifact store's JSON form: cells as
+    # [row, column, value] triples
+    valeurs, colonnes_weekend, largeurs = feuille
+    return {"valeurs": [[r, c, v] for (r, c), v in valeurs.items()], "weekend": list(colonnes_weekend), "largeurs": largeurs}
+
+def _feuille_depuis_json(donnees):
+    return {(r, c): v for r, c, v in donnees["valeurs"]}, donnees["weekend"], donnees["largeurs"]
+
+def nom_feuille_recapitulatif(is_fr=False, is_en=False, is_es=False):
+    return "Récapitulatif" if is_fr else "Summary" if is_en else "Resumen"
+
+def totaux_feuille(valeurs):
+    # {(donor, financing code): hours} of a month sheet's contents, read
+    # back from the cells so that cached sheets count as well
+    totaux = {}
+    row_idx = 9
+    while (row_idx, 2) in valeurs:
+        cle = (valeurs[(row_idx, 1)], valeurs[(row_idx, 2)])
+        heures = 0.0
+        col_idx = 4
+        while (row_idx, col_idx) in valeurs:
+            valeur = valeurs[(row_idx, col_idx)]
+            if valeur == valeur:  # NaN on weekends and holidays
+                heures += valeur
+            col_idx += 1
+        totaux[cle] = totaux.get(cle, 0.0) + heures
+        row_idx += 1
+    return totaux
+
+def lignes_recapitulatif(contexte, totaux_mois):
+    # Yearly summary sheet: one line per donor and financing code (in order
+    # of first appearance), one column per month, the year's total, and a
+    # total line. totaux_mois: [(month, totaux_feuille(...)), ...]
+    par_contrat = {}
+    for mois, totaux in totaux_mois:
+        for cle, heures in totaux.items():
+            par_contrat.setdefault(cle, [0.0] * 12)[mois - 1] += heures
+    total = "Total"
+    lignes = [["Donor", "Financing Code", *contexte["noms_mois"][1:], total]]
+    for (donor, code), heures in par_contrat.items():
+        lignes.append([donor, code, *heures, sum(heures)])
+    colonnes = [sum(heures[m] for heures in par_contrat.values()) for m in range(12)]
+    lignes.append([total, "", *colonnes, sum(colonnes)])
+    return lignes
+
+# Rows receiving the weekend fill
+LIGNES_WEEKEND = range(7, 17)
+
+def mise_en_page(ws):
+    # Set print settings: landscape orientation and fit to width
+    ws.page_setup.orientation = Worksheet.ORIENTATION_LANDSCAPE
+    ws.page_setup.fitToWidth = 1
+    ws.page_setup.fitToHeight = 0  # Allow multiple pages vertically if needed
+    ws.sheet_properties.pageSetUpPr.fitToPage = True  # Enable fit to page mode
+
+# =============================
+# Écriture en flux (write-only)
+# =============================
+
+STYLE_ATTRS = ("font", "border", "fill", "number_format", "protection", "alignment")
+
+def _appliquer_style(source, cible, styles, weekend=False):
+    # Give cible (a cell or dimension of the output workbook) the style of
+    # source (from the template, or None). Each distinct template style is
+    # registered once per output workbook; later cells reuse its StyleArray.
+    cle = (tuple(source._style) if source is not None and source.has_style else None, weekend)
+    if cle not in styles:
+        if cle[0] is not None:
+            for attr in STYLE_ATTRS:
+                setattr(cible, attr, copy(getattr(source, attr)))
+        if weekend:
+            cible.fill = WEEKEND_FILL
+        styles[cle] = copy(cible._style)
+    else:
+        cible._style = copy(styles[cle])
+
+def _copier_mise_en_forme(tpl_ws, ws, styles):
+    # Sheet-level layout carried over from the template, as copy_worksheet does
+    for attr in ("row_dimensions", "column_dimensions"):
+        source = getattr(tpl_ws, attr)
+        cible = getattr(ws, attr)
+        for key, dim in source.items():
+            nouvelle = copy(dim)
+            nouvelle.parent = ws
+            _appliquer_style(dim, nouvelle, styles)
+            cible[key] = nouvelle
+    ws.sheet_format = copy(tpl_ws.sheet_format)
+    ws.sheet_properties = copy(tpl_ws.sheet_properties)
+    ws.merged_cells = copy(tpl_ws.merged_cells)
+    ws.page_margins = copy(tpl_ws.page_margins)
+    ws.page_setup = copy(tpl_ws.page_setup)
+    ws.print_options = copy(tpl_ws.print_options)
+
+def ecrire_feuille_streaming(wb, tpl_ws, styles, titre, valeurs, colonnes_weekend, largeurs):
+    # Emit one month sheet row by row into a write-only workbook: template
+    # cells with the month's values laid over them. Nothing is kept in memory
+    # once a row has been written. Values are checked before the sheet is
+    # created: a row rejected half-way would leave a truncated sheet behind.
+    for value in valeurs.values():
+        if isinstance(value, str):
+            ecriture_xml.verifier_texte(value)
+    ws = wb.create_sheet(title=titre)
+    if tpl_ws is not None:
+        _copier_mise_en_forme(tpl_ws, ws, styles)
+    for lettre, largeur in largeurs.items():
+        ws.column_dimensions[lettre].width = largeur
+    mise_en_page(ws)
+
+    cellules_tpl = tpl_ws._cells if tpl_ws is not None else {}
+    max_row = max([tpl_ws.max_row if tpl_ws is not None else 0] + [r for r, _ in valeurs])
+    max_col = max([tpl_ws.max_column if tpl_ws is not None else 0] + [c for _, c in valeurs])
+    weekend = set(colonnes_weekend)
+    for row_idx in range(1, max_row + 1):
+        ligne = []
+        for col_idx in range(1, max_col + 1):
+            source = cellules_tpl.get((row_idx, col_idx))
+            if (row_idx, col_idx) in valeurs:
+                value = valeurs[(row_idx, col_idx)]
+            else:
+                value = source.value if source is not None else None
+            est_weekend = col_idx in weekend and row_idx in LIGNES_WEEKEND
+            if source is None and value is None and not est_weekend:
+                ligne.append(None)
+                continue
+            cell = WriteOnlyCell(ws, value=value)
+            _appliquer_style(source, cell, styles, est_weekend)
+            ligne.append(cell)
+        ws.append(ligne)
+    return ws
+
+# =============================
+# Lecture du fichier importé
+# =============================
+
+def noms_colonnes(is_fr=False, is_en=False, is_es=False):
+    return {
+        "annee": "Année" if is_fr else "Year" if is_en else "Año",
+        "mois": "Mois" if is_fr else "Month" if is_en else "Mes",
+        "heures": "Heures par jour" if is_fr else "Hours per day" if is_en else "Horas por día",
+        "feries": "Jours fériés" if is_fr else "Holidays" if is_en else "Días festivos",
+        "contrats": "Contrats" if is_fr else "Contracts" if is_en else "Contratos",
+        "donors": "Bailleurs" if is_fr else "Donors" if is_en else "Donarios",
+        "calendrier": "Calendrier" if is_fr else "Calendar" if is_en else "Calendario",
+        "nom": "Nom" if is_fr else "Name" if is_en else "Nombre",
+        "employe": "Employé" if is_fr else "Employee" if is_en else "Empleado",
+    }
+
+def nom_feuille_calendriers(is_fr=False, is_en=False, is_es=False):
+    # Optional sheet of named holiday calendars: one row per calendar, with
+    # the "nom" and "feries" columns of noms_colonnes
+    return "Calendriers" if is_fr else "Calendars" if is_en else "Calendarios"
+
+def separer_calendriers(feuilles, is_fr=False, is_en=False, is_es=False):
+    # Split the sheets of an uploaded workbook ({name: DataFrame}, as read by
+    # pd.read_excel(..., sheet_name=None)) into the rows sheet (the first
+    # other sheet) and the calendars sheet, None when absent
+    nom = nom_feuille_calendriers(is_fr, is_en, is_es)
+    lignes = next((df for titre, df in feuilles.items() if titre != nom), pd.DataFrame())
+    return lignes, feuilles.get(nom)
+
+def colonnes_requises(is_fr=False, is_en=False, is_es=False):
+    colonnes = noms_colonnes(is_fr, is_en, is_es)
+    return [colonnes["annee"], colonnes["mois"], colonnes["heures"], colonnes["contrats"]]
+
+def colonnes_manquantes(df_upload, is_fr=False, is_en=False, is_es=False):
+    return [col for col in colonnes_requises(is_fr, is_en, is_es) if col not in df_upload.columns]
+
+def message_ligne_ignoree(ligne, raison, is_fr=False, is_en=False, is_es=False):
+    return (
+        f"Ligne {ligne} ignorée : {raison}" if is_fr else
+        f"Row {ligne} skipped: {raison}" if is_en else
+        f"Fila {ligne} omitida: {raison}"
+    )
+
+def _texte(df_upload, colonne):
+    # String view of an optional column, empty where the cell is blank
+    if colonne not in df_upload.columns:
+        return pd.Series("", index=df_upload.index, dtype=object)
+    return df_upload[colonne].astype(object).where(df_upload[colonne].notna(), "").astype(str)
+
+def _entier(df_upload, colonne):
+    # Numeric column truncated to int like int(); NaN where missing or invalid
+    valeurs = pd.to_numeric(df_upload[colonne], errors="coerce")
+    return np.trunc(valeurs)
+
+def _eclater(serie):
+    # One entry per comma-separated item, indexed by the upload row and
+    # numbered within it
+    items = serie.str.split(",").explode().str.strip()
+    return items, items.groupby(level=0).cumcount()
+
+def _par_ligne(serie):
+    # {index label: [values]} for a Series whose entries of one label are
+    # contiguous (as _eclater makes them), in one pass over the flat values
+    # instead of one pandas group per label
+    if serie.empty:
+        return {}
+    etiquettes = serie.index.to_numpy()
+    valeurs = serie.tolist()
+    debuts = np.flatnonzero(np.r_[True, etiquettes[1:] != etiquettes[:-1]])
+    fins = np.r_[debuts[1:], len(valeurs)]
+    return {etiquettes[d]: valeurs[d:f] for d, f in zip(debuts, fins)}
+
+def _parser_feries(textes):
+    # {holiday list text: (frozenset of dates, [invalid items])}, each
+    # distinct text parsed once however many rows repeat it
+    distincts = pd.Series(pd.unique(textes), dtype=object)
+    items, _ = _eclater(distincts.astype(str))
+    items = items[items != ""]
+    dates = pd.to_datetime(items, format="%Y-%m-%d", errors="coerce")
+    valides = _par_ligne(dates.dropna().dt.date)
+    invalides = _par_ligne(items[dates.isna()])
+    return {texte: (frozenset(valides.get(i, ())), invalides.get(i, [])) for i, texte in distincts.items()}
+
+def normaliser_calendriers(df_calendriers, is_fr=False, is_en=False, is_es=False):
+    # {name: (frozenset of dates, [invalid items])} from the calendars sheet;
+    # a name listed on several rows gets the union of its dates
+    calendriers = {}
+    if df_calendriers is None:
+        return calendriers
+    colonnes = noms_colonnes(is_fr, is_en, is_es)
+    noms = _texte(df_calendriers, colonnes["nom"]).str.strip()
+    textes = _texte(df_calendriers, colonnes["feries"])
+    feries = _parser_feries(textes)
+    for nom, texte in zip(noms, textes):
+        if nom == "":
+            continue
+        dates, invalides = calendriers.get(nom, (frozenset(), []))
+        calendriers[nom] = (dates | feries[texte][0], invalides + feries[texte][1])
+    return calendriers
+
+def _table_vide():
+    # Typed table and validation report of an upload with a header and no rows
+    colonnes = ["ligne", "annee", "mois", "heures_par_jour", "jours_feries", "contrats", "donors", "employe", "erreurs", "valide"]
+    table = pd.DataFrame(columns=colonnes).astype({
+        "ligne": "int64", "annee": "Int64", "mois": "Int64", "heures_par_jour": "Int64", "valide": bool,
+    })
+    return table, pd.DataFrame(columns=["ligne", "probleme"])
+
+def normaliser_upload(df_upload, is_fr=False, is_en=False, is_es=False, calendriers=None):
+    # Parse and validate the whole upload at once with pandas string
+    # operations. Returns the typed table (one row per upload row, with the
+    # parsed holidays, contracts and donors) and the validation report: one
+    # (row number, localized reason) entry per problem found, every problem
+    # of every row, so nothing is discovered halfway through generation.
+    # calendriers: the optional calendars sheet (see separer_calendriers),
+    # or the dict normaliser_calendriers made of it; a row's holidays are
+    # its calendar's dates plus its own list.
+    if df_upload.empty:
+        return _table_vide()
+    colonnes = noms_colonnes(is_fr, is_en, is_es)
+    index = df_upload.index
+    problemes = []
+
+    def signaler(lignes, raisons):
+        problemes.extend(zip(lignes, raisons))
+
+    annee = _entier(df_upload, colonnes["annee"])
+    mois = _entier(df_upload, colonnes["mois"])
+    heures = _entier(df_upload, colonnes["heures"])
+    for nom, valide in (
+        (colonnes["annee"], annee.between(1, 9999)),
+        (colonnes["mois"], mois.between(1, 12)),
+        (colonnes["heures"], heures.between(1, 24)),
+    ):
+        brut = df_upload[nom][~valide]
+        signaler(brut.index, [
+            f"valeur invalide pour « {nom} » : {v}" if is_fr else
+            f"invalid value for '{nom}': {v}" if is_en else
+            f"valor inválido para «{nom}»: {v}"
+            for v in brut
+        ])
+
+    # Holidays: YYYY-MM-DD dates, blanks ignored, plus the named calendar.
+    # Rows with the same calendar and list share one frozenset, which is
+    # also the key of the working-day index (see calendrier.py)
+    textes = _texte(df_upload, colonnes["feries"])
+    noms_calendriers = _texte(df_upload, colonnes["calendrier"]).str.strip()
+    feries = _parser_feries(textes)
+    if not isinstance(calendriers, dict):
+        calendriers = normaliser_calendriers(calendriers, is_fr, is_en, is_es)
+    cles = list(zip(noms_calendriers, textes))
+    combinaisons = {}
+    for nom, texte in set(cles):
+        dates, invalides = feries[texte]
+        raisons = [
+            f"date de jour férié invalide : {d}" if is_fr else
+            f"invalid holiday date: {d}" if is_en else
+            f"fecha de día festivo inválida: {d}"
+            for d in invalides
+        ]
+        if nom and nom not in calendriers:
+            raisons.append(
+                f"calendrier inconnu : {nom}" if is_fr else
+                f"unknown calendar: {nom}" if is_en else
+                f"calendario desconocido: {nom}"
+            )
+        elif nom:
+            dates_calendrier, invalides_calendrier = calendriers[nom]
+            dates = dates | dates_calendrier
+            raisons += [
+                f"date invalide dans le calendrier « {nom} » : {d}" if is_fr else
+                f"invalid date in calendar '{nom}': {d}" if is_en else
+                f"fecha inválida en el calendario «{nom}»: {d}"
+                for d in invalides_calendrier
+            ]
+        combinaisons[nom, texte] = (dates, raisons)
+    jours_feries = pd.Series([combinaisons[cle][0] for cle in cles], index=index, dtype=object)
+    for idx, cle in zip(index, cles):
+        if combinaisons[cle][1]:
+            signaler([idx] * len(combinaisons[cle][1]), combinaisons[cle][1])
+
+    # Contracts: CODE:PERCENT items
+    items, position = _eclater(_texte(df_upload, colonnes["contrats"]))
+    parties = items.str.extract(r"^([^:]*?)\s*:\s*([^:]*)$")
+    pourcentages = pd.to_numeric(parties[1], errors="coerce")
+    mal_formes = items[parties[0].isna() | (parties[0] == "") | pourcentages.isna()]
+    signaler(mal_formes.index, [
+        f"contrat invalide : '{c}' (format attendu CODE:POURCENTAGE)" if is_fr else
+        f"invalid contract: '{c}' (expected CODE:PERCENT)" if is_en else
+        f"contrato inválido: '{c}' (formato esperado CÓDIGO:PORCENTAJE)"
+        for c in mal_formes
+    ])
+    # Codes are the keys of the row's contracts: a repeated code would be
+    # merged into one contract holding a single one of its percentages
+    codes_lignes = pd.DataFrame({"ligne": items.index, "code": parties[0].to_numpy()})
+    codes_lignes = codes_lignes[codes_lignes["code"].notna() & (codes_lignes["code"] != "")]
+    doublons = codes_lignes[codes_lignes.duplicated()].drop_duplicates()
+    signaler(doublons["ligne"], [
+        f"code de financement en double : {c}" if is_fr else
+        f"duplicate financing code: {c}" if is_en else
+        f"código de financiación duplicado: {c}"
+        for c in doublons["code"]
+    ])
+    # A share of the hours lies in [0, 100]; inf or -50 could still sum to
+    # 100 and would break the allocation
+    hors_bornes = pourcentages.notna() & ~pourcentages.between(0, 100)
+    signaler(items.index[hors_bornes.to_numpy()], [
+        f"pourcentage invalide pour le contrat « {c} » : {p} (attendu entre 0 et 100)" if is_fr else
+        f"invalid percentage for contract '{c}': {p} (expected between 0 and 100)" if is_en else
+        f"porcentaje inválido para el contrato «{c}»: {p} (se espera entre 0 y 100)"
+        for c, p in zip(parties[0][hors_bornes], pourcentages[hors_bornes])
+    ])
+    nb_contrats = items.groupby(level=0).size()
+    somme = pourcentages.groupby(level=0).sum()
+    rejetees = set(mal_formes.index) | set(items.index[hors_bornes.to_numpy()])
+
+    # Donors: matched to contracts by position
+    donors_items, donors_position = _eclater(_texte(df_upload, colonnes["donors"]))
+    nb_donors = donors_items.groupby(level=0).size()
+    ecart = nb_donors.reindex(index) != nb_contrats.reindex(index)
+    signaler(index[ecart.to_numpy()], [
+        f"nombre de donors ({d}) différent du nombre de contrats ({c})" if is_fr else
+        f"number of donors ({d}) does not match number of contracts ({c})" if is_en else
+        f"número de donantes ({d}) diferente al número de contratos ({c})"
+        for d, c in zip(nb_donors.reindex(index)[ecart], nb_contrats.reindex(index)[ecart])
+    ])
+    hors_total = (~somme.reindex(index).sub(100).abs().lt(1e-6)) & ~index.isin(rejetees)
+    signaler(index[hors_total.to_numpy()], [
+        f"la somme des pourcentages de contrats n'est pas 100 (somme: {s})" if is_fr else
+        f"contract percentages do not sum to 100 (sum: {s})" if is_en else
+        f"los porcentajes de contratos no suman 100 (suma: {s})"
+        for s in somme.reindex(index)[hors_total]
+    ])
+
+    # Assemble the typed table; only per-row dict building is left in Python,
+    # one pass over the flat items (see _par_ligne)
+    donors_items = pd.Series(
+        donors_items.to_numpy(), index=pd.MultiIndex.from_arrays([donors_items.index, donors_position])
+    ).reindex(pd.MultiIndex.from_arrays([items.index, position])).fillna("").to_numpy()
+    codes = _par_ligne(parties[0])
+    pcts = _par_ligne(pourcentages)
+    noms_donors = _par_ligne(pd.Series(donors_items, index=items.index))
+    contrats = pd.Series({idx: dict(zip(codes[idx], pcts[idx])) for idx in codes}, dtype=object)
+    donors = pd.Series({idx: dict(zip(codes[idx], noms_donors[idx])) for idx in codes}, dtype=object)
+
+    erreurs = pd.Series([[] for _ in index], index=index, dtype=object)
+    for idx, raison in problemes:
+        erreurs[idx].append(raison)
+    table = pd.DataFrame({
+        "ligne": index + 1,
+        "annee": annee.astype("Int64"),
+        "mois": mois.astype("Int64"),
+        "heures_par_jour": heures.astype("Int64"),
+        "jours_feries": jours_feries,
+        "contrats": contrats.reindex(index),
+        "donors": donors.reindex(index),
+        # Optional grouping column: employee or cost centre
+        "employe": _texte(df_upload, colonnes["employe"]).str.strip(),
+        "erreurs": erreurs,
+    }, index=index)
+    table["valide"] = table["erreurs"].str.len() == 0
+    logger.debug("Upload parsed: %d rows, %d valid, %d problems", len(table), int(table["valide"].sum()), len(problemes))
+    rapport = pd.DataFrame(
+        [(idx + 1, raison) for idx, raison in sorted(problemes, key=lambda p: index.get_loc(p[0]))],
+        columns=["ligne", "probleme"],
+    )
+    return table, rapport
+
+def grouper_par_annee(table):
+    # [(year, [parsed row, ...]), ...] for the valid rows, one group (one
+    # workbook) per employee and year, in upload order within each group.
+    # Without an employee column there is a single group per year.
+    groupes = []
+    valides = table[table["valide"]]
+    for (employe, annee), group in valides.groupby(["employe", "annee"], sort=True):
+        lignes = [
+            {
+                "ligne": int(row.ligne), "annee": int(annee), "mois": int(row.mois),
+                "heures_par_jour": int(row.heures_par_jour), "jours_feries": row.jours_feries,
+                "contrats": row.contrats, "donors": row.donors, "employe": employe,
+            }
+            for row in group.itertuples(index=False)
+        ]
+        groupes.append((int(annee), lignes))
+    return groupes
+
+def lignes_ignorees(table, is_fr=False, is_en=False, is_es=False):
+    # (row number, localized message) pairs of the invalid rows of a table
+    return [
+        (int(row.ligne), message_ligne_ignoree(int(row.ligne), "; ".join(row.erreurs), is_fr, is_en, is_es))
+        for row in table[~table["valide"]].itertuples(index=False)
+    ]
+
+def parser_upload(df_upload, is_fr=False, is_en=False, is_es=False, calendriers=None):
+    # Returns the rows grouped by year as [(year, [parsed row, ...]), ...] and
+    # the (row number, localized message) pairs of the rows that were skipped
+    table, _ = normaliser_upload(df_upload, is_fr, is_en, is_es, calendriers)
+    return grouper_par_annee(table), lignes_ignorees(table, is_fr, is_en, is_es)
+
+# Upload formats; CSV and Parquet are read in blocks of this many rows
+FORMATS_UPLOAD = (".xlsx", ".csv", ".parquet")
+TAILLE_BLOC_UPLOAD = int(os.environ.get("TIMESHEETS_UPLOAD_BLOCK_ROWS", 50000))
+
+def _parquet():
+    # pyarrow is optional: only Parquet input and output need it
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet files need the optional 'pyarrow' package (pip install pyarrow)") from e
+    return pq
+
+def _blocs_parquet(source, taille_bloc):
+    debut = 0
+    for lot in _parquet().ParquetFile(source).iter_batches(batch_size=taille_bloc):
+        bloc = lot.to_pandas()
+        # Numbered across blocks like read_csv's chunks: row numbers in the
+        # validation report stay those of the file
+        bloc.index = pd.RangeIndex(debut, debut + len(bloc))
+        debut += len(bloc)
+        yield bloc
+
+def lire_upload(source, nom=None, is_fr=False, is_en=False, is_es=False, taille_bloc=None):
+    # Upload in any of FORMATS_UPLOAD, chosen by the extension of nom (the
+    # path itself when source is one). Returns an iterator over the rows in
+    # blocks of DataFrames, for normaliser_blocs, and the calendars sheet or
+    # None. CSV and Parquet are streamed taille_bloc rows at a time; an xlsx
+    # file is read whole, as a single block, with its optional calendars.
+    taille_bloc = taille_bloc or TAILLE_BLOC_UPLOAD
+    extension = os.path.splitext(str(nom if nom is not None else source))[1].lower()
+    if extension == ".csv":
+        return pd.read_csv(source, chunksize=taille_bloc), None
+    if extension == ".parquet":
+        return _blocs_parquet(source, taille_bloc), None
+    df_upload, calendriers = separer_calendriers(pd.read_excel(source, sheet_name=None), is_fr, is_en, is_es)
+    return iter([df_upload]), calendriers
+
+def normaliser_blocs(blocs, is_fr=False, is_en=False, is_es=False, calendriers=None):
+    # normaliser_upload over an upload read in blocks (see lire_upload): the
+    # raw text of each block is released once it has been parsed, so the
+    # whole file is never held as text and as parsed table at the same time
+    calendriers = normaliser_calendriers(calendriers, is_fr, is_en, is_es)
+    tables, rapports = [], []
+    for bloc in blocs:
+        table, rapport = normaliser_upload(bloc, is_fr, is_en, is_es, calendriers)
+        tables.append(table)
+        rapports.append(rapport)
+    if not tables:
+        # A file with a header and no rows
+        return _table_vide()
+    return pd.concat(tables), pd.concat(rapports, ignore_index=True)
+
+# =============================
+# Génération par lots
+# =============================
+
+# Sheet writer: "openpyxl" (write-only workbook) or "xml" (raw template XML)
+MOTEURS_ECRITURE = ("openpyxl", "xml")
+MOTEUR_ECRITURE = os.environ.get("TIMESHEETS_WRITER", "openpyxl")
+
+# Number of worker processes used for batch generation (1 = serial)
+NB_WORKERS = int(os.environ.get("TIMESHEETS_WORKERS", os.cpu_count() or 1))
+# Below this many rows the pool's start-up cost outweighs the gain
+SEUIL_PARALLELE = int(os.environ.get("TIMESHEETS_PARALLEL_MIN_ROWS", 24))
+# Groups queued in the pool per worker process
+GROUPES_PAR_WORKER = 2
+# Add a yearly summary sheet (per-contract totals by month) to each workbook
+RECAPITULATIF_ANNUEL = os.environ.get("TIMESHEETS_YEAR_SUMMARY", "") not in ("", "0")
+# Size above which the output ZIP is split into parts (0 = a single ZIP)
+TAILLE_PARTIE_ZIP = int(float(os.environ.get("TIMESHEETS_ZIP_PART_MB", 200)) * 1024 * 1024)
+
+# The pool is created on first use and kept for the life of the process,
+# so successive batches don't pay the worker start-up again
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+def _pool(workers):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # spawn rather than fork: the Streamlit server is multi-threaded
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        return _executor
+
+def _contenu_ligne(ligne):
+    # Normalized row inputs: everything that shapes the generated sheet
+    contenu = [
+        ligne["annee"], ligne["mois"], ligne["heures_par_jour"],
+        sorted(d.isoformat() for d in ligne["jours_feries"]),
+        list(ligne["contrats"].items()), list(ligne["donors"].items()),
+    ]
+    # Only when set, so rows without an employee keep their former seed;
+    # with one, two employees with the same inputs get different plannings
+    if ligne.get("employe"):
+        contenu.append(ligne["employe"])
+    return contenu
+
+def graine_ligne(ligne):
+    # Seed derived from the row content only, so a row always gets the same
+    # allocation whichever process generates it and in whatever order
+    contenu = json.dumps(_contenu_ligne(ligne))
+    return int.from_bytes(hashlib.sha256(contenu.encode("utf-8")).digest()[:8], "big")
+
+def cle_ligne(ligne, is_fr=False, is_en=False, is_es=False, mode=MODE_ALLOCATION):
+    # Cache key of a generated sheet: the row inputs plus everything else the
+    # sheet depends on (language, allocation engine and seed)
+    langue = "fr" if is_fr else "en" if is_en else "es"
+    contenu = json.dumps([_contenu_ligne(ligne), langue, mode, graine_ligne(ligne)])
+    return hashlib.sha256(contenu.encode("utf-8")).hexdigest()
+
+def generer_classeur_annuel(annee, lignes, is_fr=False, is_en=False, is_es=False, mode=MODE_ALLOCATION, destination=None, cache=None, moteur=MOTEUR_ECRITURE, recapitulatif=RECAPITULATIF_ANNUEL):
+    # lignes: parsed upload rows (dicts) of one year, in upload order.
+    # The workbook is streamed with openpyxl's write-only mode into
+    # destination (a path or binary file); without one, the xlsx bytes are
+    # returned instead. Returns the year, destination or bytes, the
+    # (row number, localized message) pairs of the rows that were skipped,
+    # and the workbook's performance measurements (see instrumentation.py).
+    # cache: optional dict of sheet contents by cle_ligne; rows found there,
+    # or in the shared artifact store (see artefacts.py), skip the allocation
+    # and filling, and new sheets are added to both.
+    # moteur: "openpyxl" (write-only workbook) or "xml" (template XML filled
+    # directly, see ecriture_xml.py); without a template, openpyxl is used.
+    # The year's shared layout (see contexte_annee) is built once; with
+    # recapitulatif, a last sheet sums every contract by month.
+    tpl_ws = trame = None
+    try:
+        if moteur == "xml":
+            trame = trame_xml()
+        else:
+            tpl_ws = template_en_lecture().worksheets[0]
+    except FileNotFoundError:
+        logger.warning("Template 'Trame timesheet.xlsx' not found. Creating new file...")
+    tpl_empreinte = empreinte_template()
+    if trame is not None:
+        sortie = destination if destination is not None else BytesIO()
+        classeur = ecriture_xml.ouvrir_classeur(trame, sortie)
+    else:
+        wb = openpyxl.Workbook(write_only=True)
+    # The xml writer holds the destination open until fermer_classeur
+    ferme = False
+    try:
+        styles = {}
+        titres = set()
+        erreurs = []
+        mesures = mesure_classeur(annee, lignes[0].get("employe", "") if lignes else "")
+        with chrono(mesures["temps"], "fill", mesures["memoire"]):
+            contexte = contexte_annee(annee, is_fr, is_en, is_es)
+        totaux_mois = []
+
+        # Look every row up in the caches first, so that all the missing sheets
+        # are allocated together in one batch (see repartir_lot)
+        a_traiter = []
+        manquantes = []
+        for ligne in lignes:
+            mesure = mesure_ligne(ligne, annee)
+            temps = mesure["temps"]
+            entree = {"ligne": ligne, "mesure": mesure, "feuille": None, "erreur": None}
+            try:
+                entree["cle"] = cle_ligne(ligne, is_fr, is_en, is_es, mode)
+                entree["cle_artefact"] = artefacts.empreinte(entree["cle"], tpl_empreinte)
+                feuille = cache.get(entree["cle"]) if cache is not None else None
+                if feuille is None:
+                    donnees = artefacts.lire_json("feuilles", entree["cle_artefact"])
+                    feuille = _feuille_depuis_json(donnees) if donnees is not None else None
+                if feuille is None:
+                    with chrono(temps, "calendar", mesures["memoire"]):
+                        entree["jours_ouvres"] = get_jours_ouvres(ligne["mois"], annee, ligne["jours_feries"])
+                    manquantes.append(entree)
+                else:
+                    mesure["cache"] = True
+                    entree["feuille"] = feuille
+            except Exception as e:
+                entree["erreur"] = e
+            a_traiter.append(entree)
+
+        if manquantes:
+            temps_lot = {}
+            with chrono(temps_lot, "allocate", mesures["memoire"]):
+                try:
+                    _, tenseur = repartir_lot(
+                        [entree["ligne"]["contrats"] for entree in manquantes],
+                        [entree["ligne"]["heures_par_jour"] for entree in manquantes],
+                        [len(entree["jours_ouvres"]) for entree in manquantes],
+                        [graine_ligne(entree["ligne"]) for entree in manquantes],
+                        mode=mode,
+                        essais=[entree["mesure"]["essais"] for entree in manquantes],
+                    )
+                    for i, entree in enumerate(manquantes):
+                        entree["matrice"] = tenseur[i, :len(entree["ligne"]["contrats"]), :len(entree["jours_ouvres"])]
+                except Exception:
+                    # One bad row must not cost the others their sheets: allocate
+                    # again row by row (same seeds, same values) and record each
+                    # failure on its own row
+                    tenseur = None
+                    for entree in manquantes:
+                        entree["mesure"]["essais"].clear()
+                        try:
+                            _, tenseur_ligne = repartir_lot(
+                                [entree["ligne"]["contrats"]], [entree["ligne"]["heures_par_jour"]], [len(entree["jours_ouvres"])],
+                                [graine_ligne(entree["ligne"])], mode=mode, essais=[entree["mesure"]["essais"]],
+                            )
+                            entree["matrice"] = tenseur_ligne[0, :len(entree["ligne"]["contrats"]), :len(entree["jours_ouvres"])]
+                        except Exception as e:
+                            entree["erreur"] = e
+            allouees = [entree for entree in manquantes if entree["erreur"] is None]
+            if allouees:
+                # Rows served from the caches were audited when first generated
+                with chrono(mesures["temps"], "audit", mesures["memoire"]):
+                    if tenseur is not None:
+                        mesures["audit"] = audit.auditer([entree["ligne"] for entree in manquantes], tenseur)
+                    else:
+                        mesures["audit"] = audit.fusionner(
+                            audit.auditer([entree["ligne"]], entree["matrice"][None]) for entree in allouees
+                        )
+            # The batch's time is shared evenly between its rows
+            part = temps_lot["allocate"] / len(manquantes)
+            for entree in manquantes:
+                temps = entree["mesure"]["temps"]
+                temps["allocate"] = temps.get("allocate", 0.0) + part
+
+        for entree in a_traiter:
+            ligne, mesure, feuille = entree["ligne"], entree["mesure"], entree["feuille"]
+            temps = mesure["temps"]
+            try:
+                if entree["erreur"] is not None:
+                    raise entree["erreur"]
+                if feuille is None:
+                    with chrono(temps, "fill", mesures["memoire"]):
+                        feuille = contenu_feuille_annee(contexte, ligne, entree["jours_ouvres"], entree["matrice"])
+                    artefacts.ecrire_json("feuilles", entree["cle_artefact"], _feuille_json(feuille))
+                if cache is not None:
+                    cache[entree["cle"]] = feuille
+                valeurs, colonnes_weekend, largeurs = feuille
+                # Same numbering as openpyxl for a month listed twice
+                titre = contexte["noms_mois"][ligne["mois"]]
+                suffixe = 1
+                while titre.lower() in titres:
+                    titre = f"{contexte['noms_mois'][ligne['mois']]}{suffixe}"
+                    suffixe += 1
+                with chrono(temps, "write", mesures["memoire"]):
+                    if trame is not None:
+                        ecriture_xml.ajouter_feuille(classeur, titre, valeurs, colonnes_weekend, largeurs)
+                    else:
+                        ecrire_feuille_streaming(wb, tpl_ws, styles, titre, valeurs, colonnes_weekend, largeurs)
+                titres.add(titre.lower())
+                if recapitulatif:
+                    totaux_mois.append((ligne["mois"], totaux_feuille(valeurs)))
+            except Exception as e:
+                erreurs.append((ligne["ligne"], message_ligne_ignoree(ligne["ligne"], e, is_fr, is_en, is_es)))
+            mesures["lignes"].append(mesure)
+        if titres and recapitulatif:
+            with chrono(mesures["temps"], "write", mesures["memoire"]):
+                lignes_recap = lignes_recapitulatif(contexte, totaux_mois)
+                titre = nom_feuille_recapitulatif(is_fr, is_en, is_es)
+                if trame is not None:
+                    ecriture_xml.ajouter_feuille_simple(classeur, titre, lignes_recap)
+                else:
+                    ws = wb.create_sheet(title=titre)
+                    for ligne_recap in lignes_recap:
+                        ws.append(ligne_recap)
+        if not titres and trame is not None:
+            ecriture_xml.ajouter_feuille_simple(classeur, "Info", [["Info"], ["No valid rows"]])
+        elif not titres:
+            ws = wb.create_sheet(title="Info")
+            ws.append(["Info"])
+            ws.append(["No valid rows"])
+        with chrono(mesures["temps"], "save", mesures["memoire"]):
+            if trame is not None:
+                ecriture_xml.fermer_classeur(classeur)
+                ferme = True
+                contenu = sortie.getvalue() if destination is None else destination
+                mesures["octets"] = (
+                    len(contenu) if destination is None else
+                    os.path.getsize(destination) if isinstance(destination, str) else destination.tell()
+                )
+            elif destination is None:
+                output = BytesIO()
+                wb.save(output)
+                contenu = output.getvalue()
+                mesures["octets"] = len(contenu)
+            else:
+                wb.save(destination)
+                contenu = destination
+                mesures["octets"] = os.path.getsize(destination) if isinstance(destination, str) else destination.tell()
+    finally:
+        if trame is not None and not ferme:
+            ecriture_xml.abandonner_classeur(classeur)
+    return annee, contenu, erreurs, mesures
+
+def _generer_classeur_avec_cache(annee, lignes, is_fr, is_en, is_es, mode, destination, connues, moteur, recapitulatif):
+    # Pool task: the worker gets the cached sheets of its rows and sends the
+    # newly generated ones back, the caller's cache lives in another process
+    cache = dict(connues)
+    resultat = generer_classeur_annuel(annee, lignes, is_fr, is_en, is_es, mode, destination, cache, moteur, recapitulatif)
+    return resultat, {cle: feuille for cle, feuille in cache.items() if cle not in connues}
+
+def generer_lot(groupes, is_fr=False, is_en=False, is_es=False, mode=MODE_ALLOCATION, workers=NB_WORKERS, progression=None, repertoire=None, cache=None, moteur=MOTEUR_ECRITURE, recapitulatif=RECAPITULATIF_ANNUEL):
+    # groupes: list of (year, parsed rows). Workbooks are spread over a
+    # process pool and returned in the original order; progression(n) is
+    # called in the calling thread with the number of rows of each finished
+    # group. Seeds come from the rows, so serial and parallel runs fill the
+    # workbooks with the same values. With a repertoire, each workbook is
+    # written there as a file and its path is returned instead of its bytes,
+    # so the batch never holds more than one workbook in memory. With a
+    # cache (see generer_classeur_annuel), only rows missing from it are
+    # regenerated and the workbooks are reassembled from the cached sheets.
+    resultats = [None] * len(groupes)
+    noms = noms_fichiers(groupes, is_fr, is_en, is_es)
+    destinations = [os.path.join(repertoire, nom) if repertoire else None for nom in noms]
+    nb_lignes = sum(len(lignes) for _, lignes in groupes)
+    if workers <= 1 or len(groupes) <= 1 or nb_lignes < SEUIL_PARALLELE:
+        for i, (annee, lignes) in enumerate(groupes):
+            resultats[i] = generer_classeur_annuel(annee, lignes, is_fr, is_en, is_es, mode, destinations[i], cache, moteur, recapitulatif)
+            if progression:
+                progression(len(lignes))
+        return resultats
+
+    # Only a few groups are queued at a time: with hundreds of employees the
+    # pending tasks (their rows and known sheets) and the results waiting to
+    # be collected stay bounded, whatever the size of the upload
+    executor = _pool(workers)
+    a_soumettre = iter(enumerate(groupes))
+    futures = {}
+
+    def soumettre_suivant():
+        for i, (annee, lignes) in a_soumettre:
+            if cache is None:
+                future = executor.submit(generer_classeur_annuel, annee, lignes, is_fr, is_en, is_es, mode, destinations[i], None, moteur, recapitulatif)
+            else:
+                cles = (cle_ligne(ligne, is_fr, is_en, is_es, mode) for ligne in lignes)
+                connues = {cle: cache[cle] for cle in cles if cle in cache}
+                future = executor.submit(_generer_classeur_avec_cache, annee, lignes, is_fr, is_en, is_es, mode, destinations[i], connues, moteur, recapitulatif)
+            futures[future] = i
+            return
+
+    for _ in range(workers * GROUPES_PAR_WORKER):
+        soumettre_suivant()
+    while futures:
+        terminees, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in terminees:
+            i = futures.pop(future)
+            if cache is None:
+                resultats[i] = future.result()
+            else:
+                resultats[i], nouvelles = future.result()
+                cache.update(nouvelles)
+            if progression:
+                progression(len(groupes[i][1]))
+            soumettre_suivant()
+    return resultats
+
+def nom_fichier_annuel(annee, is_fr=False, is_en=False, is_es=False, employe=""):
+    # Employee names are reduced to characters safe in file names
+    if employe:
+        employe = re.sub(r"[^\w.-]+", "_", employe).strip("_.") or "_"
+        annee = f"{employe}_{annee}"
+    return (
+        f"plannings_{annee}.xlsx" if is_fr else
+        f"timesheets_{annee}.xlsx" if is_en else
+        f"horarios_{annee}.xlsx"
+    )
+
+def _nom_unique(nom, pris):
+    # nom, or nom with a numeric suffix when another file already took it
+    # (two employees whose names reduce to the same file name)
+    racine, extension = os.path.splitext(nom)
+    suffixe = 2
+    while nom.lower() in pris:
+        nom = f"{racine}_{suffixe}{extension}"
+        suffixe += 1
+    pris.add(nom.lower())
+    return nom
+
+def noms_fichiers(groupes, is_fr=False, is_en=False, is_es=False):
+    # One distinct workbook file name per group
+    pris = set()
+    return [
+        _nom_unique(nom_fichier_annuel(annee, is_fr, is_en, is_es, lignes[0].get("employe", "") if lignes else ""), pris)
+        for annee, lignes in groupes
+    ]
+
+def _ajouter_classeur(zipf, resultat, pris, is_fr, is_en, is_es):
+    # Workbooks given as paths keep their file name and are streamed from
+    # disk into the archive in chunks
+    annee, contenu, _, mesures = resultat
+    if isinstance(contenu, (bytes, bytearray)):
+        nom = _nom_unique(nom_fichier_annuel(annee, is_fr, is_en, is_es, mesures.get("employe", "")), pris)
+        zipf.writestr(nom, contenu)
+    else:
+        zipf.write(contenu, _nom_unique(os.path.basename(contenu), pris))
+
+def ecrire_zip(resultats, destination, is_fr=False, is_en=False, is_es=False):
+    # destination: path or binary file object
+    pris = set()
+    with zipfile.ZipFile(destination, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for resultat in resultats:
+            _ajouter_classeur(zipf, resultat, pris, is_fr, is_en, is_es)
+
+def ecrire_zips(resultats, destination, is_fr=False, is_en=False, is_es=False, taille_max=None):
+    # ecrire_zip into a path, split into several archives of about
+    # taille_max bytes (TAILLE_PARTIE_ZIP by default, 0 for a single one).
+    # A part is closed after the workbook that takes it past the limit, so it
+    # overshoots by at most one workbook; file names stay unique across
+    # parts. Returns the archive paths: [destination] when everything fits
+    # in one, otherwise destination's name with _part1, _part2...
+    taille_max = TAILLE_PARTIE_ZIP if taille_max is None else taille_max
+    racine, extension = os.path.splitext(destination)
+    chemins = []
+    pris = set()
+    zipf = None
+    try:
+        for resultat in resultats:
+            if zipf is None:
+                chemins.append(f"{racine}_part{len(chemins) + 1}{extension}")
+                zipf = zipfile.ZipFile(chemins[-1], "w", zipfile.ZIP_DEFLATED)
+            _ajouter_classeur(zipf, resultat, pris, is_fr, is_en, is_es)
+            if taille_max and sum(info.compress_size for info in zipf.infolist()) >= taille_max:
+                zipf.close()
+                zipf = None
+    finally:
+        if zipf is not None:
+            zipf.close()
+    if len(chemins) <= 1:
+        if chemins:
+            os.replace(chemins[0], destination)
+        else:
+            ecrire_zip([], destination)
+        return [destination]
+    return chemins
+
+def generer_zip_temporaire(groupes, is_fr=False, is_en=False, is_es=False, mode=MODE_ALLOCATION, workers=NB_WORKERS, progression=None, temps=None, cache=None, moteur=MOTEUR_ECRITURE, taille_max=None, memoire=None, recapitulatif=RECAPITULATIF_ANNUEL):
+    # Memory-bounded batch: workbooks go to a scratch directory, then into
+    # ZIP parts (see ecrire_zips) in a temporary directory. Returns the ZIP
+    # paths (the caller deletes them and their directory) and the
+    # generation results; the ZIP packing time is added to temps when given,
+    # and its memory peaks to memoire (see instrumentation.chrono).
+    with tempfile.TemporaryDirectory(prefix="timesheets_") as repertoire:
+        resultats = generer_lot(groupes, is_fr, is_en, is_es, mode, workers, progression, repertoire, cache, moteur, recapitulatif)
+        repertoire_zip = tempfile.mkdtemp(prefix="timesheets_zip_")
+        with chrono(temps if temps is not None else {}, "zip", memoire):
+            chemins = ecrire_zips(resultats, os.path.join(repertoire_zip, "timesheets.zip"), is_fr, is_en, is_es, taille_max)
+    return chemins, resultats
+
+# =============================
+# Grand livre (export à plat)
+# =============================
+
+# Ledger columns; fixed English names, the ledger is read by other systems
+COLONNES_GRAND_LIVRE = ["row", "employee", "year", "month", "day", "donor", "financing_code", "hours"]
+FORMATS_GRAND_LIVRE = (".csv", ".parquet")
+# Upload rows allocated together by blocs_grand_livre
+TAILLE_BLOC_GRAND_LIVRE = int(os.environ.get("TIMESHEETS_LEDGER_BLOCK_ROWS", 5000))
+
+def auditer_lot(groupes, mode=MODE_ALLOCATION, taille_bloc=None):
+    # Audit (see audit.py) of the allocation of a whole upload before any
+    # workbook is written, taille_bloc rows at a time: the same seeds, so
+    # the same values as the workbooks and the ledger
+    lignes = [ligne for _, lignes_groupe in groupes for ligne in lignes_groupe]
+    taille_bloc = taille_bloc or TAILLE_BLOC_GRAND_LIVRE
+    rapports = []
+    for debut in range(0, len(lignes), taille_bloc):
+        bloc = lignes[debut:debut + taille_bloc]
+        try:
+            rapports.append(_auditer_bloc(bloc, mode))
+        except Exception:
+            # A row that cannot be allocated fails the audit on its own: the
+            # block is audited again row by row (same seeds, same values)
+            for ligne in bloc:
+                try:
+                    rapports.append(_auditer_bloc([ligne], mode))
+                except Exception as e:
+                    rapports.append(audit.echec_allocation(ligne, e))
+    return audit.fusionner(rapports)
+
+def _auditer_bloc(bloc, mode):
+    _, tenseur = repartir_lot(
+        [ligne["contrats"] for ligne in bloc],
+        [ligne["heures_par_jour"] for ligne in bloc],
+        [len(get_jours_ouvres(ligne["mois"], ligne["annee"], ligne["jours_feries"])) for ligne in bloc],
+        [graine_ligne(ligne) for ligne in bloc],
+        mode=mode,
+    )
+    return audit.auditer(bloc, tenseur)
+
+def grand_livre(groupes, mode=MODE_ALLOCATION):
+    # Flat allocation table of a whole upload (groupes as for generer_lot),
+    # built from one repartir_lot call without any workbook: one line per
+    # upload row, working day and contract with hours, the same values as in
+    # the workbooks generated with the same mode (same seeds).
+    return _grand_livre([ligne for _, lignes_groupe in groupes for ligne in lignes_groupe], mode)
+
+def blocs_grand_livre(groupes, mode=MODE_ALLOCATION, taille_bloc=None):
+    # The same lines as grand_livre, taille_bloc upload rows at a time: the
+    # rows x contracts x days array of the whole upload is never built.
+    # Seeds come from the rows, so the blocks give the same values.
+    lignes = [ligne for _, lignes_groupe in groupes for ligne in lignes_groupe]
+    taille_bloc = taille_bloc or TAILLE_BLOC_GRAND_LIVRE
+    for debut in range(0, len(lignes), taille_bloc):
+        yield _grand_livre(lignes[debut:debut + taille_bloc], mode)
+
+def _grand_livre(lignes, mode):
+    if not lignes:
+        return pd.DataFrame(columns=COLONNES_GRAND_LIVRE)
+    jours_ouvres = [get_jours_ouvres(ligne["mois"], ligne["annee"], ligne["jours_feries"]) for ligne in lignes]
+    _, tenseur = repartir_lot(
+        [ligne["contrats"] for ligne in lignes],
+        [ligne["heures_par_jour"] for ligne in lignes],
+        [len(jours) for jours in jours_ouvres],
+        [graine_ligne(ligne) for ligne in lignes],
+        mode=mode,
+    )
+    # Padded lookup tables next to the rows x contracts x days array
+    nb_lignes, nb_contrats, nb_jours = tenseur.shape
+    codes = np.full((nb_lignes, nb_contrats), "", dtype=object)
+    donors = np.full((nb_lignes, nb_contrats), "", dtype=object)
+    jours = np.zeros((nb_lignes, nb_jours), dtype=int)
+    for i, ligne in enumerate(lignes):
+        codes[i, :len(ligne["contrats"])] = list(ligne["contrats"])
+        donors[i, :len(ligne["contrats"])] = [ligne["donors"].get(code, "") for code in ligne["contrats"]]
+        jours[i, :len(jours_ouvres[i])] = [jour.day for jour in jours_ouvres[i]]
+    # Padding is zero, so hours > 0 keeps real cells only; ordered by row,
+    # day, then contract
+    i, d, c = np.nonzero(tenseur.transpose(0, 2, 1) > 0)
+    return pd.DataFrame({
+        "row": np.array([ligne["ligne"] for ligne in lignes])[i],
+        "employee": np.array([ligne.get("employe", "") for ligne in lignes], dtype=object)[i],
+        "year": np.array([ligne["annee"] for ligne in lignes])[i],
+        "month": np.array([ligne["mois"] for ligne in lignes])[i],
+        "day": jours[i, d],
+        "donor": donors[i, c],
+        "financing_code": codes[i, c],
+        "hours": tenseur[i, c, d],
+    }, columns=COLONNES_GRAND_LIVRE)
+
+def ecrire_grand_livre(df_grand_livre, destination, format_fichier=None):
+    # df_grand_livre: the ledger, or an iterable of ledger blocks (see
+    # blocs_grand_livre) written one after the other. destination: path or
+    # binary file; format_fichier (".csv" or ".parquet") defaults to the
+    # extension of the path. Returns the number of lines written.
+    format_fichier = format_fichier or os.path.splitext(str(destination))[1].lower()
+    if format_fichier not in FORMATS_GRAND_LIVRE:
+        raise ValueError(f"Unknown ledger format: {format_fichier} (expected one of {', '.join(FORMATS_GRAND_LIVRE)})")
+    blocs = [df_grand_livre] if isinstance(df_grand_livre, pd.DataFrame) else df_grand_livre
+    nb_lignes = 0
+    if format_fichier == ".parquet":
+        pq = _parquet()
+        import pyarrow as pa
+        schema = writer = None
+        try:
+            for bloc in blocs:
+                table = pa.Table.from_pandas(bloc, schema=schema, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(destination, schema)
+                writer.write_table(table)
+                nb_lignes += len(bloc)
+            if writer is None:
+                # No rows at all: still a readable file with the columns
+                pd.DataFrame(columns=COLONNES_GRAND_LIVRE).to_parquet(destination, index=False)
+        finally:
+            if writer is not None:
+                writer.close()
+        return nb_lignes
+    if isinstance(destination, str):
+        with open(destination, "w", encoding="utf-8", newline="") as f:
+            return ecrire_grand_livre(blocs, f, format_fichier)
+    entete = True
+    for bloc in blocs:
+        bloc.to_csv(destination, index=False, header=entete)
+        entete = False
+        nb_lignes += len(bloc)
+    if entete:
+        pd.DataFrame(columns=COLONNES_GRAND_LIVRE).to_csv(destination, index=False)
+    return nb_lignes
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import rapport_performance, journaliser_rapport
+from planning import MODE_ALLOCATION, MOTEUR_ECRITURE, RECAPITULATIF_ANNUEL, cle_ligne, generer_zip_temporaire
+
+# Background batch jobs. A job runs on a thread pool of the server process,
+# outside any Streamlit script run, so reruns (widget changes) and page
+# refreshes don't interrupt it. Its status and ZIP live in a directory per
+# job under TIMESHEETS_JOBS_DIR; the app only keeps the job ID (in session
+# state and in the URL) and polls etat().
+#
+# States: "en_attente" -> "en_cours" -> "termine" | "echec". A job found on
+# disk still pending or running after a server restart is "interrompu".
+# A finished job lists its ZIP parts in "zips" (several above
+# planning.TAILLE_PARTIE_ZIP).
+
+logger = logging.getLogger(__name__)
+
+REPERTOIRE_TRAVAUX = os.environ.get("TIMESHEETS_JOBS_DIR", os.path.join(tempfile.gettempdir(), "timesheets_jobs"))
+# Jobs running at the same time; each one may also use the process pool
+NB_TRAVAUX = int(os.environ.get("TIMESHEETS_JOB_WORKERS", 2))
+# Finished jobs and their ZIP are deleted after this many hours
+DUREE_CONSERVATION = float(os.environ.get("TIMESHEETS_JOBS_TTL_HOURS", 24)) * 3600
+
+FICHIER_ETAT = "etat.json"
+FICHIER_ZIP = "timesheets.zip"
+FICHIER_PARTIE_ZIP = "timesheets_part{}.zip"
+
+_travaux = {}
+_lock = threading.Lock()
+_executor = None
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=NB_TRAVAUX, thread_name_prefix="timesheets-job")
+        return _executor
+
+def _repertoire(job_id):
+    return os.path.join(REPERTOIRE_TRAVAUX, job_id)
+
+def _enregistrer(travail):
+    # Status written next to the ZIP, atomically, so a restarted server (or
+    # another process) can still serve finished jobs
+    repertoire = _repertoire(travail["id"])
+    fd, temporaire = tempfile.mkstemp(dir=repertoire, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(travail, f)
+    os.replace(temporaire, os.path.join(repertoire, FICHIER_ETAT))
+
+def _mettre_a_jour(job_id, **champs):
+    with _lock:
+        travail = _travaux[job_id]
+        travail.update(champs)
+        instantane = dict(travail)
+    _enregistrer(instantane)
+
+def _executer(job_id, groupes, is_fr, is_en, is_es, mode, temps, cache, moteur, recapitulatif):
+    _mettre_a_jour(job_id, etat="en_cours", debut=time.time())
+
+    def avancer(nb_lignes):
+        with _lock:
+            _travaux[job_id]["lignes_faites"] += nb_lignes
+        _mettre_a_jour(job_id)
+
+    memoire = {}
+    try:
+        chemins_zip, resultats = generer_zip_temporaire(groupes, is_fr, is_en, is_es, mode, progression=avancer, temps=temps, cache=cache, moteur=moteur, memoire=memoire, recapitulatif=recapitulatif)
+        destinations = []
+        for numero, chemin_zip in enumerate(chemins_zip, start=1):
+            nom = FICHIER_ZIP if len(chemins_zip) == 1 else FICHIER_PARTIE_ZIP.format(numero)
+            destinations.append(os.path.join(_repertoire(job_id), nom))
+            shutil.move(chemin_zip, destinations[-1])
+        shutil.rmtree(os.path.dirname(chemins_zip[0]), ignore_errors=True)
+        if cache is not None:
+            # Keep only the sheets of this upload in the session cache
+            cles = {cle_ligne(ligne, is_fr, is_en, is_es, mode) for _, lignes in groupes for ligne in lignes}
+            for cle in [cle for cle in cache if cle not in cles]:
+                cache.pop(cle, None)
+        rapport = rapport_performance([mesures for _, _, _, mesures in resultats], temps, sum(os.path.getsize(chemin) for chemin in destinations), memoire_lot=memoire)
+        journaliser_rapport(rapport)
+        erreurs = sorted(erreur for _, _, erreurs_annee, _ in resultats for erreur in erreurs_annee)
+        _mettre_a_jour(job_id, etat="termine", fin=time.time(), zips=destinations, erreurs=erreurs, rapport=rapport)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        _mettre_a_jour(job_id, etat="echec", fin=time.time(), message=str(e))
+
+def soumettre(groupes, is_fr=False, is_en=False, is_es=False, mode=MODE_ALLOCATION, temps=None, cache=None, moteur=MOTEUR_ECRITURE, recapitulatif=RECAPITULATIF_ANNUEL):
+    # Queue the generation of groupes (see planning.generer_lot) and return
+    # the job ID at once. temps: stage times already measured (parse), added
+    # to the job's performance report. cache: the session's sheet cache.
+    # recapitulatif: add the yearly summary sheet to each workbook.
+    purger()
+    job_id = uuid.uuid4().hex
+    os.makedirs(_repertoire(job_id), exist_ok=True)
+    travail = {
+        "id": job_id,
+        "etat": "en_attente",
+        "langue": "fr" if is_fr else "en" if is_en else "es",
+        "lignes_total": sum(len(lignes) for _, lignes in groupes),
+        "lignes_faites": 0,
+        "soumis": time.time(),
+        "debut": None,
+        "fin": None,
+        "zips": [],
+        "erreurs": [],
+        "rapport": None,
+        "message": None,
+    }
+    with _lock:
+        _travaux[job_id] = travail
+    _enregistrer(travail)
+    _pool().submit(_executer, job_id, groupes, is_fr, is_en, is_es, mode, dict(temps or {}), cache, moteur, recapitulatif)
+    return job_id
+
+def etat(job_id):
+    # Copy of the job's status, or None for an unknown or purged job
+    with _lock:
+        if job_id in _travaux:
+            return dict(_travaux[job_id])
+    try:
+        with open(os.path.join(_repertoire(os.path.basename(job_id)), FICHIER_ETAT), encoding="utf-8") as f:
+            travail = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if travail["etat"] in ("en_attente", "en_cours"):
+        # Not in this process's table: the server restarted mid-job
+        travail["etat"] = "interrompu"
+    return travail
+
+def oublier(job_id):
+    # Delete a job's files; a job still running is left alone
+    travail = etat(job_id)
+    if travail is None or travail["etat"] in ("en_attente", "en_cours"):
+        return
+    with _lock:
+        _travaux.pop(job_id, None)
+    shutil.rmtree(_repertoire(os.path.basename(job_id)), ignore_errors=True)
+
+def purger():
+    # Delete the jobs that finished more than DUREE_CONSERVATION ago
+    limite = time.time() - DUREE_CONSERVATION
+    try:
+        noms = os.listdir(REPERTOIRE_TRAVAUX)
+    except FileNotFoundError:
+        return
+    for nom in noms:
+        travail = etat(nom)
+        if travail is None:
+            continue
+        if travail["etat"] not in ("en_attente", "en_cours") and (travail["fin"] or travail["soumis"]) < limite:
+            oublier(nom)